@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+## Keeps the results of the alignment on disk, so that re-running a burst
+#  with different post-processing settings does not align it again. An entry
+#  is identified by a hash of the content of the image files and of all
+#  parameters the alignment depends on, so that changing any of them misses
+#  the cache. If the total size of the entries exceeds max_bytes, the least
+#  recently used ones are deleted.
+class AlignmentCache:
+    
+    # increment if the format of the entries changes
+    format_version = 1
+    
+    ## The constructor
+    #  @param directory directory of the cache entries. It is created if it
+    #  does not exist.
+    #  @param max_bytes maximum total size of the entries in bytes
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        
+    ## Calculate the key of an alignment
+    #  @param image_paths list of paths of the images in the order they are
+    #  aligned in
+    #  @param parameters dictionary of all parameters the alignment depends
+    #  on. The values must be serializable as JSON.
+    #  @return key as hex string
+    def calculateKey(self, image_paths, parameters):
+        key_hash = hashlib.sha256()
+        key_hash.update(json.dumps({"format_version" : self.format_version,
+                                    "parameters" : parameters},
+                                   sort_keys=True).encode())
+        for image_path in image_paths:
+            key_hash.update(self.hashFile(image_path).encode())
+        return key_hash.hexdigest()
+        
+    ## Hash the content of a file
+    #  @param path path of the file
+    #  @return sha256 hash as hex string
+    def hashFile(self, path):
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+        
+    def getEntryPath(self, key):
+        return os.path.join(self.directory, key + ".npz")
+        
+    def contains(self, key):
+        return os.path.exists(self.getEntryPath(key))
+        
+    ## Fill the transform matrices and correlation coefficients of a dataset
+    #  from the cache
+    #  @param key key as calculated by calculateKey
+    #  @param dataset ImageDataHolder object. Transform matrices it already
+    #  has, e.g. from a checkpoint, are replaced.
+    #  @return True if the entry was found, else False
+    def load(self, key, dataset):
+        entry_path = self.getEntryPath(key)
+        try:
+            with np.load(entry_path) as entry:
+                transform_matrices = entry["transform_matrices"]
+                correlation_coefficients = entry["correlation_coefficients"]
+        except (OSError, KeyError, ValueError):
+            # missing, or broken by an interrupted write of another process
+            return False
+            
+        if len(transform_matrices) != dataset.getImageCount():
+            return False
+            
+        for index in range(len(transform_matrices)):
+            dataset.transform_matrices[index] = []
+            dataset.correlation_coefficients[index] = []
+            for transform_matrix, correlation_coefficient in zip(transform_matrices[index],
+                                                                 correlation_coefficients[index]):
+                dataset.appendTransformMatrix(index, transform_matrix)
+                dataset.appendCorrelationCoefficient(index,
+                                                     None if np.isnan(correlation_coefficient)
+                                                     else float(correlation_coefficient))
+                
+        # mark the entry as recently used
+        os.utime(entry_path)
+        return True
+        
+    ## Store the transform matrices and correlation coefficients of a dataset
+    #  @param key key as calculated by calculateKey
+    #  @param dataset ImageDataHolder object with filled transform matrices
+    def store(self, key, dataset):
+        transform_matrices = np.array(dataset.transform_matrices, dtype=np.float32)
+        correlation_coefficients = np.array([[np.nan if correlation_coefficient is None else correlation_coefficient
+                                              for correlation_coefficient in image_correlation_coefficients]
+                                             for image_correlation_coefficients in dataset.correlation_coefficients],
+                                            dtype=np.float64)
+        
+        # write into a temporary file first, so that other processes never
+        # see a partially written entry
+        file_descriptor, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                np.savez(file,
+                         transform_matrices=transform_matrices,
+                         correlation_coefficients=correlation_coefficients)
+            os.replace(temporary_path, self.getEntryPath(key))
+        except:
+            os.remove(temporary_path)
+            raise
+            
+        self.enforceSizeLimit()
+        
+    ## Delete an entry
+    #  @param key key as calculated by calculateKey
+    def invalidate(self, key):
+        if self.contains(key):
+            os.remove(self.getEntryPath(key))
+            
+    ## Delete all entries
+    def clear(self):
+        for entry_path in glob.glob(os.path.join(self.directory, "*.npz")):
+            os.remove(entry_path)
+            
+    ## Delete the least recently used entries until the total size is within
+    #  max_bytes
+    def enforceSizeLimit(self):
+        entries = []
+        for entry_path in glob.glob(os.path.join(self.directory, "*.npz")):
+            try:
+                status = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, entry_path))
+            
+        total_bytes = sum(entry[1] for entry in entries)
+        for modification_time, size, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            total_bytes -= size
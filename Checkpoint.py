@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+## Saves the progress of a stacking run, so that an aborted or killed run can
+#  be resumed. A checkpoint consists of the transform matrices of the images
+#  aligned so far and the sum of the images stacked so far with their count.
+#
+#  The sum is written to its own .npy file, which is only referenced by the
+#  state file after it has been written completely. The state file is
+#  replaced atomically, so that a run killed while saving leaves the previous
+#  checkpoint intact.
+class Checkpoint:
+
+    # increment if the format of the checkpoints changes
+    format_version = 1
+
+    ## The constructor
+    #  @param directory directory of the checkpoint. It is created if it does
+    #  not exist.
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    ## Calculate the key of a run. A checkpoint is only resumed by a run with
+    #  the same key. The images are identified by path, size and modification
+    #  time instead of their content, which would have to be read completely.
+    #  @param image_paths list of paths of the images in the order they are
+    #  stacked in
+    #  @param parameters dictionary of all parameters the result depends on.
+    #  The values must be serializable as JSON.
+    #  @return key as hex string
+    def calculateKey(self, image_paths, parameters):
+        images = []
+        for image_path in image_paths:
+            status = os.stat(image_path)
+            images.append([os.path.abspath(image_path), status.st_size, status.st_mtime_ns])
+        return hashlib.sha256(json.dumps({"format_version" : self.format_version,
+                                          "parameters" : parameters,
+                                          "images" : images},
+                                         sort_keys=True).encode()).hexdigest()
+
+    def getStatePath(self):
+        return os.path.join(self.directory, "checkpoint.npz")
+
+    ## Save the progress of a run
+    #  @param key key as calculated by calculateKey
+    #  @param dataset ImageDataHolder object. The transform matrices of all
+    #  images that have them are saved.
+    #  @param stacked_image sum of the stacked images as numpy array or None
+    #  @param num_stacked_images number of images in stacked_image, which are
+    #  the first ones of the dataset
+    def save(self, key, dataset, stacked_image=None, num_stacked_images=0):
+        num_images = dataset.getImageCount()
+        aligned = np.array([len(transform_matrices) > 0
+                            for transform_matrices in dataset.transform_matrices])
+        num_tiles = max(len(transform_matrices) for transform_matrices in dataset.transform_matrices)
+        transform_matrices = np.zeros((num_images, num_tiles, 2, 3), np.float32)
+        correlation_coefficients = np.full((num_images, num_tiles), np.nan)
+        for index in np.flatnonzero(aligned):
+            transform_matrices[index] = dataset.transform_matrices[index]
+            correlation_coefficients[index] = [np.nan if correlation_coefficient is None else correlation_coefficient
+                                               for correlation_coefficient in dataset.correlation_coefficients[index]]
+
+        stack_file_name = ""
+        if stacked_image is not None and num_stacked_images > 0:
+            file_descriptor, stack_path = tempfile.mkstemp(prefix="stack_",
+                                                           suffix=".npy",
+                                                           dir=self.directory)
+            with os.fdopen(file_descriptor, "wb") as file:
+                np.lib.format.write_array(file, stacked_image)
+            stack_file_name = os.path.basename(stack_path)
+
+        file_descriptor, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                np.savez(file,
+                         key=np.array(key),
+                         aligned=aligned,
+                         transform_matrices=transform_matrices,
+                         correlation_coefficients=correlation_coefficients,
+                         num_stacked_images=np.array(num_stacked_images),
+                         stack_file_name=np.array(stack_file_name))
+            os.replace(temporary_path, self.getStatePath())
+        except:
+            os.remove(temporary_path)
+            raise
+
+        # delete the sums of previous checkpoints and left overs of killed
+        # runs
+        self.removeFiles(exclude=stack_file_name)
+
+    ## Load the progress of a run
+    #  @param key key as calculated by calculateKey
+    #  @param dataset ImageDataHolder object with empty transform matrices.
+    #  The saved transform matrices are filled in.
+    #  @return tuple (number of stacked images, sum of the stacked images as
+    #  read-only numpy memmap or None), or None if there is no checkpoint
+    #  with the given key
+    def load(self, key, dataset):
+        try:
+            with np.load(self.getStatePath()) as state:
+                if str(state["key"]) != key:
+                    return None
+                aligned = state["aligned"]
+                transform_matrices = state["transform_matrices"]
+                correlation_coefficients = state["correlation_coefficients"]
+                num_stacked_images = int(state["num_stacked_images"])
+                stack_file_name = str(state["stack_file_name"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+        stacked_image = None
+        if stack_file_name:
+            try:
+                stacked_image = np.load(os.path.join(self.directory, stack_file_name),
+                                        mmap_mode="r")
+            except (OSError, ValueError):
+                return None
+
+        for index in np.flatnonzero(aligned):
+            for transform_matrix, correlation_coefficient in zip(transform_matrices[index],
+                                                                 correlation_coefficients[index]):
+                dataset.appendTransformMatrix(index, transform_matrix)
+                dataset.appendCorrelationCoefficient(index,
+                                                     None if np.isnan(correlation_coefficient)
+                                                     else float(correlation_coefficient))
+        return num_stacked_images, stacked_image
+
+    ## Delete the checkpoint
+    def remove(self):
+        if os.path.exists(self.getStatePath()):
+            os.remove(self.getStatePath())
+        self.removeFiles()
+
+    ## Delete the stack files and temporary files in the directory
+    #  @param exclude name of a file that is kept
+    def removeFiles(self, exclude=None):
+        for path in (glob.glob(os.path.join(self.directory, "stack_*.npy"))
+                     + glob.glob(os.path.join(self.directory, "*.tmp"))):
+            if os.path.basename(path) != exclude:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -35,4 +35,88 @@ def preprocessImage(image, scale_factor, data_type=np.float32, interpolation=cv2
                  fy=scale_factor,
                  interpolation=interpolation)
                  
-    return image_upscaled
\ No newline at end of file
+    return image_upscaled
+
+## Convert a float image into 8 bit, rounding and saturating like OpenCV does
+#  @param image image as float numpy array
+#  @return image as uint8 numpy array
+def convertToUint8(image):
+    image_8u = np.rint(image)
+    np.clip(image_8u, 0, 255, out=image_8u)
+    return image_8u.astype(np.uint8)
+
+## Convert a BGR image into greyscale. Greyscale images are returned as they
+#  are, e.g. from the greyscale plane of a FrameStore.
+#  @param image image as numpy array
+#  @return greyscale image as numpy array
+def convertToGray(image):
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+## Convert an affine transform matrix into another coordinate frame. The
+#  coordinates of the new frame are given as p_new = scale * p + offset, for
+#  example for the same image resampled by a scale factor.
+#  @param transform_matrix 2x3 affine transform matrix as numpy array
+#  @param scale scale factor between the coordinate frames
+#  @param offset offset of the coordinate frames as sequence [x, y]
+#  @return converted transform matrix as float32 numpy array
+def convertTransformMatrix(transform_matrix, scale, offset=(0., 0.)):
+    linear_part = transform_matrix[:, :2]
+    translation = transform_matrix[:, 2]
+    offset = np.asarray(offset, dtype=np.float64)
+    
+    converted_transform_matrix = np.empty((2, 3), np.float32)
+    converted_transform_matrix[:, :2] = linear_part
+    converted_transform_matrix[:, 2] = (scale * translation
+                                        + offset
+                                        - np.dot(linear_part, offset))
+    return converted_transform_matrix
+
+## Combine upscaling and the warp of a tile into one transform matrix, so
+#  that the aligned tile can be interpolated directly from the raw image.
+#  @param transform_matrix 2x3 affine transform matrix of the tile in
+#  coordinates of the tile in the upscaled image, used with WARP_INVERSE_MAP
+#  @param scale_factor upscaling factor
+#  @param tile_origin [x, y] of the tile in the upscaled image
+#  @param output_origin [x, y] of the first output pixel in the upscaled
+#  image, e.g. the first pixel of the tile without margins
+#  @return 2x3 transform matrix from output pixels to raw image pixels as
+#  float64 numpy array, to be used with WARP_INVERSE_MAP
+def calculateUpscalingTransformMatrix(transform_matrix, scale_factor,
+                                      tile_origin, output_origin):
+    linear_part = transform_matrix[:, :2].astype(np.float64)
+    translation = transform_matrix[:, 2].astype(np.float64)
+    tile_origin = np.asarray(tile_origin, dtype=np.float64)
+    output_offset = np.asarray(output_origin, dtype=np.float64) - tile_origin
+    
+    # output pixel -> pixel of the tile -> warped pixel of the tile -> pixel
+    # of the upscaled image -> pixel of the raw image, with pixel centers
+    # mapped like cv2.resize does
+    upscaling_transform_matrix = np.empty((2, 3), np.float64)
+    upscaling_transform_matrix[:, :2] = linear_part / scale_factor
+    upscaling_transform_matrix[:, 2] = ((np.dot(linear_part, output_offset)
+                                         + translation
+                                         + tile_origin
+                                         + 0.5) / scale_factor
+                                        - 0.5)
+    return upscaling_transform_matrix
+
+## Upscale a region of an image without upscaling the whole image. The
+#  result is the same as cropping the output of preprocessImage.
+#  @param image image as float numpy array
+#  @param scale_factor upscaling factor
+#  @param x_range [min, max] of the region in upscaled coordinates
+#  @param y_range [min, max] of the region in upscaled coordinates
+#  @return upscaled region as numpy array
+def upscaleRegion(image, scale_factor, x_range, y_range, interpolation=cv2.INTER_CUBIC):
+    # map the pixel centers of the region to the pixel centers of the image
+    # in the same way cv2.resize does
+    transform_matrix = np.array([[1. / scale_factor, 0., (x_range[0] + 0.5) / scale_factor - 0.5],
+                                 [0., 1. / scale_factor, (y_range[0] + 0.5) / scale_factor - 0.5]])
+    region_upscaled = cv2.warpAffine(image,
+                                     transform_matrix,
+                                     (int(x_range[1] - x_range[0]), int(y_range[1] - y_range[0])),
+                                     flags=interpolation + cv2.WARP_INVERSE_MAP,
+                                     borderMode=cv2.BORDER_REPLICATE)
+    return region_upscaled
\ No newline at end of file
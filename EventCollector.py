@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+## Sink of the Instrumentation that keeps all events in memory, e.g. for
+#  displaying statistics in the GUI
+class EventCollector:
+
+    def __init__(self):
+        self.events = []
+
+    def recordEvent(self, event):
+        self.events.append(event)
+
+    def clear(self):
+        self.events = []
+
+    ## Get the recorded events
+    #  @param event name of the events to get. If None, all events are
+    #  returned.
+    #  @return list of event dictionaries
+    def getEvents(self, event=None):
+        return [record for record in self.events
+                if event is None or record["event"] == event]
+
+    ## Summarize the timed events by name
+    #  @return dictionary of event name to dictionary of {count,
+    #  total_seconds, mean_seconds, max_seconds}
+    def getSummary(self):
+        summary = {}
+        for record in self.events:
+            if "seconds" not in record:
+                continue
+            statistics = summary.setdefault(record["event"],
+                                            {"count" : 0,
+                                             "total_seconds" : 0.,
+                                             "max_seconds" : 0.})
+            statistics["count"] += 1
+            statistics["total_seconds"] += record["seconds"]
+            statistics["max_seconds"] = max(statistics["max_seconds"], record["seconds"])
+        for statistics in summary.values():
+            statistics["mean_seconds"] = statistics["total_seconds"] / statistics["count"]
+        return summary
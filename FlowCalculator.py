@@ -17,179 +17,161 @@
     along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import CommonFunctions
+import concurrent.futures
+import os
 import cv2
 import numpy as np
-import os
 
-## Provides a Method to calculate OpenCV maps for a series of images
-#  that can be used to correct seeing distortion with the OpenCV remap function
+## Calculates the distortion of each image by seeing or heat shimmer as the
+#  optical flow between the aligned images. The distortion is measured
+#  relative to the mean flow of all images, which approximates the real shape
+#  of the object better than the reference image.
+#
+#  The flows are calculated at the resolution of the raw images, in parallel
+#  threads, and stored as float16. Only the sum of the flows is kept in full
+#  precision for the mean, so memory does not grow with full-size float32
+#  flows per image.
 class FlowCalculator:
-    def __init__(self, config, scale_factor):
-        self.config = config
-
-        self.extension = int(config["FITS_Options"]["extension"])
-        self.scale_factor = scale_factor        
+    def __init__(self):
+        # parameters of cv2.calcOpticalFlowFarneback
+        self.pyr_scale = 0.5
+        self.levels = 3
+        self.winsize = 15
+        self.iterations = 3
+        self.poly_n = 5
+        self.poly_sigma = 1.2
         
-        self.optical_flow_output_directory = config["Filepaths"]["monitoring_images_output_directory"]
+        # number of threads calculating flows. 0 uses all cores.
+        self.num_workers = 1
         
-        self.pyr_scale = float(config["Optical_Flow_Options"]["pyr_scale"])
-        self.levels = int(config["Optical_Flow_Options"]["levels"])
-        self.winsize = int(config["Optical_Flow_Options"]["winsize"])
-        self.iterations = int(config["Optical_Flow_Options"]["iterations"])
-        self.poly_n = int(config["Optical_Flow_Options"]["poly_n"])
-        self.poly_sigma = float(config["Optical_Flow_Options"]["poly_sigma"])
+        # if set, a colorful representation of each flow is written into
+        # this directory, in the background if an ImageWriter is given
+        self.optical_flow_output_directory = None
+        self.image_writer = None
         
-    
-    ## calculate a Distortion map based on optical flow
-    #  @param dataset ImageDataHolder object with filled hdulists, filled
-    #  transform matrices and empty distortion maps
-    #  @return dataset with filled tansform_matrices for upscaled images
-    #  @todo: do not calculate distortion relative to reference image, 
-    #  but as average!
-    def calculateDistortionMaps(self, dataset):
-        # set the first image as reference
-        first_data = dataset.getData(0)
-        first_hdu_image = first_data["hdu_list"][self.extension].data
-        image_reference = CommonFunctions.preprocessHduImage(first_hdu_image, 
-                                                             self.scale_factor)
-    
-        # @todo: for case that alignment is not relative to first image, also
-        # do alignment transformation for first image!
-    
-        # calculate the optical flows for each image
-        list_optical_flows = self.calculateOpticalFlowsForDataset(image_reference,
-                                                                  dataset)
-                                                  
-        # calculate the mean optical flow in order to correct the seeing
-        # not relative to the reference image, but relative to the
-        # average shape which should approximate the real object better.
-        optical_flow_mean =  self.calculateMeanOpticalFlow(list_optical_flows)                                               
-                     
-        # calculate the distortion maps from optical flows for each image
-        num_optical_flows = len(list_optical_flows)           
-        for index in range(num_optical_flows):   
-            
-            optical_flow = list_optical_flows[index]
-            
-            # subtract mean optical flow
-            optical_flow -= optical_flow_mean
-                 
-            # create the distortion map from the optical flow vectorfield
-            distortion_map = self.convertOpticalFlowToDistortionMap(optical_flow)
-
-            # set the distortion map in the dataset for this image 
-            dataset.setDistortionMap(index, distortion_map)
-
-        return dataset
-
-
-    ## Calculates optical flows for a set of images relative to first image
-    #  @param image_reference reference image as numpy float32 array
-    #  @param dataset ImageDataHolder object with filled hdulists, filled
-    #  transform matrices and empty distortion maps
-    #  @return list object containing optical flows as numpy array
-    def calculateOpticalFlowsForDataset(self, image_reference, dataset):
-        # optical flows will be stored here        
-        list_optical_flows = []
+    ## Calculate the distortion maps of all images and set them in the dataset
+    #  @param dataset ImageDataHolder object with filled transform matrices
+    #  @param getAlignedImage callable that takes the index of an image and
+    #  returns the aligned image at raw resolution as single channel numpy
+    #  float32 array
+    #  @param createArray callable that takes a shape and a dtype and returns
+    #  an array of zeros for the flows, e.g. a memory mapped one
+    #  @param continue_processing list with one bool; processing is aborted if
+    #  it is set to False
+    #  @param status_callback callable that is called with a status string
+    #  @return "aborted" if aborted, else None. The distortion maps are
+    #  optical flows of shape (height, width, 2) as float16 at raw resolution,
+    #  to be applied to the aligned image with image(p + flow(p)).
+    def calculateDistortionMaps(self, dataset, getAlignedImage, createArray,
+                                continue_processing, status_callback):
+        image_reference = getAlignedImage(0)
+        num_images = dataset.getImageCount()
         
-        # add zero optical flow for the reference image which is at first position
-        shape_image_reference = image_reference.shape
-        shape_optical_flow = [shape_image_reference[0],
-                              shape_image_reference[1],
-                              2] 
-        zero_optical_flow = np.zeros(shape_optical_flow, np.float32)
-        list_optical_flows.append(zero_optical_flow)
+        optical_flows = createArray((num_images,) + image_reference.shape + (2,),
+                                    np.float16)
+        optical_flow_sum = np.zeros(image_reference.shape + (2,), np.float64)
         
-        # iterate through the dataset and calculate the optical flow for each
-        # except the first one
-        num_images = dataset.getImageCount()
-        for index in range(1, num_images):
-            
-            print ("calculating optical flow for image ", index)      
-            
-            # Get the image at the index
-            data = dataset.getData(index)
-            hdu_image = data["hdu_list"][self.extension].data
-            image = CommonFunctions.preprocessHduImage(hdu_image, 
-                                                       self.scale_factor)
-            
-            # @todo: here, do not use config but simply check if matrix is None
-            # apply the transformation to the input image
-            if self.config["Processing_Options"]["align_images"] == "True":
-                # get the image dimension
-                image_shape = image.shape
-                
-                # Transform the Image
-                image = cv2.warpAffine(image,
-                                       data["transform_matrix"],
-                                       (image_shape[1],image_shape[0]),
-                                       flags=cv2.INTER_CUBIC + cv2.WARP_INVERSE_MAP)       
-            
-            # calculate the optical flow (backwards for warping!)
-            optical_flow = cv2.calcOpticalFlowFarneback(image_reference,
-                                                        image,
-                                                        None,
-                                                        self.pyr_scale,
-                                                        self.levels,
-                                                        self.winsize,
-                                                        self.iterations,
-                                                        self.poly_n,
-                                                        self.poly_sigma,
-                                                        cv2.OPTFLOW_FARNEBACK_GAUSSIAN)
-
-            # Write out optical flow images for user evaluation
-            self.writeOpticalFlowImage(index, optical_flow)
-
-            list_optical_flows.append(optical_flow)
-            
-        return list_optical_flows
-
-    
-    ## Average a list of optical flows
-    #  @param list_optical_flows list object containing optical flows as numpy arrays
-    #  @return averaged optical flow as numpy array
-    def calculateMeanOpticalFlow(self, list_optical_flows):
-        # create zero optical flow where other flows will be added and averaged
-        optical_flow_mean = np.zeros_like(list_optical_flows[0])  
+        # the optical flow of the reference image is zero
+        result = self.calculateOpticalFlows(image_reference, getAlignedImage,
+                                            range(1, num_images), optical_flows,
+                                            optical_flow_sum, continue_processing,
+                                            status_callback)
+        if result == "aborted":
+            return "aborted"
         
-        # average all optical flows in list
-        num_optical_flows = len(list_optical_flows)
-        for optical_flow in list_optical_flows:
-            optical_flow_mean += optical_flow / float(num_optical_flows)
-            
-        return optical_flow_mean
-
-
-    ## Calculate an OpenCV map that can be used to remap an image according
-    #  to the optical flow vector field using OpenCV remap function
-    #  @param optical_flow optical flow as numpy array
-    #  @param distortion_map OpenCV map as numpy array
-    def convertOpticalFlowToDistortionMap(self, optical_flow):
-        # get x and y resolution of optical flow (and so also of image)    
-        shape_optical_flow = optical_flow.shape[:-1]
+        optical_flow_mean = (optical_flow_sum / num_images).astype(np.float32)
+        del optical_flow_sum
         
-        # create empty distortion maps for x and y separately because 
-        # opencv remap needs this
-        distortion_map_x = np.zeros(shape_optical_flow, np.float32) # only x and y
-        distortion_map_y = np.zeros(shape_optical_flow, np.float32) # only x and y 
+        for index in range(num_images):
+            optical_flows[index] = optical_flows[index] - optical_flow_mean
+            dataset.setDistortionMap(index, optical_flows[index])
+            
+    ## Calculate the optical flows of the images relative to the reference
+    #  image in parallel. Only twice as many images as there are workers are
+    #  processed at once, so that memory stays bounded.
+    #  @param image_reference reference image as numpy float32 array
+    #  @param indices indices of the images
+    #  @param optical_flows array the flows are written into by image index
+    #  @param optical_flow_sum numpy float64 array the flows are added to
+    #  @return "aborted" if aborted, else None
+    def calculateOpticalFlows(self, image_reference, getAlignedImage, indices,
+                              optical_flows, optical_flow_sum,
+                              continue_processing, status_callback):
+        calculateOpticalFlow = lambda index: self.calculateOpticalFlow(image_reference,
+                                                                       getAlignedImage(index))
+        indices = list(indices)
+        num_workers = self.num_workers if self.num_workers > 0 else os.cpu_count()
         
-        # fill the distortion maps
-        for x in range(shape_optical_flow[1]):
-            distortion_map_x[:,x] = optical_flow[:,x,0] + x
-        for y in range(shape_optical_flow[0]):
-            distortion_map_y[y] = optical_flow[y,:,1] + y
-                
-        distortion_map = [distortion_map_x, distortion_map_y]                
-                
-        return distortion_map
-
-    ## Create a colorful representation of the optical flow, where intensity
-    #  denotes vector length and huw denotes vector direction
+        # cv2.calcOpticalFlowFarneback releases the GIL, so threads suffice
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = {}
+            next_position = 0
+            num_finished = 0
+            while num_finished < len(indices):
+                if continue_processing[0] == False:
+                    for future in futures:
+                        future.cancel()
+                    return "aborted"
+                    
+                while next_position < len(indices) and len(futures) < 2 * num_workers:
+                    index = indices[next_position]
+                    futures[executor.submit(calculateOpticalFlow, index)] = index
+                    next_position += 1
+                    
+                done, pending = concurrent.futures.wait(futures,
+                                                        timeout=0.5,
+                                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    index = futures.pop(future)
+                    optical_flow = future.result()
+                    optical_flows[index] = optical_flow
+                    optical_flow_sum += optical_flow
+                    num_finished += 1
+                    
+                    print ("calculated optical flow for image ", index)
+                    status_callback("calculating optical flows: " + str(num_finished)
+                                    + " of " + str(len(indices)) + " done")
+                    
+                    # Write out optical flow images for user evaluation
+                    if self.optical_flow_output_directory is not None:
+                        self.writeOpticalFlowImage(index, optical_flow)
+                        
+    ## Calculate the optical flow of an image relative to the reference image
+    #  @param image_reference reference image as numpy float32 array
+    #  @param image aligned image as numpy float32 array
+    #  @return optical flow as numpy float32 array of shape (height, width, 2)
+    def calculateOpticalFlow(self, image_reference, image):
+        # calculate the optical flow (backwards for warping!)
+        return cv2.calcOpticalFlowFarneback(image_reference,
+                                            image,
+                                            None,
+                                            self.pyr_scale,
+                                            self.levels,
+                                            self.winsize,
+                                            self.iterations,
+                                            self.poly_n,
+                                            self.poly_sigma,
+                                            cv2.OPTFLOW_FARNEBACK_GAUSSIAN)
+
+    ## Write a colorful representation of the optical flow into the output
+    #  directory
+    #  @param index index of the image
+    #  @param optical_flow optical flow as numpy float32 array. It must not be
+    #  modified afterwards.
     def writeOpticalFlowImage(self, index, optical_flow):
         filename = "flow_" + str(index) + ".png"
         output_path = os.path.join(self.optical_flow_output_directory, filename)
+        if self.image_writer is not None:
+            self.image_writer.write(output_path, optical_flow,
+                                    self.visualizeOpticalFlow)
+        else:
+            cv2.imwrite(output_path, self.visualizeOpticalFlow(optical_flow))
 
+    ## Create a colorful representation of the optical flow, where intensity
+    #  denotes vector length and huw denotes vector direction
+    #  @param optical_flow optical flow as numpy float32 array
+    #  @return BGR image as numpy uint8 array
+    def visualizeOpticalFlow(self, optical_flow):
         # create hsv image
         shape_optical_flow = optical_flow.shape[:-1]
         shape_hsv = [shape_optical_flow[0], shape_optical_flow[1], 3]
@@ -202,6 +184,6 @@ class FlowCalculator:
         mag, ang = cv2.cartToPolar(optical_flow[:,:,0], optical_flow[:,:,1])
         hsv[:,:,0] = ang*180/np.pi/2
         hsv[:,:,2] = cv2.normalize(mag,None,0,255,cv2.NORM_MINMAX)
-        bgr = cv2.cvtColor(hsv,cv2.COLOR_HSV2BGR)
-
-        cv2.imwrite(output_path, bgr)
\ No newline at end of file
+        
+        # the value ranges are the ones of 8 bit images
+        return cv2.cvtColor(hsv.astype(np.uint8),cv2.COLOR_HSV2BGR)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import threading
+import zlib
+import numpy as np
+
+## Keeps decoded frames in memory up to a configurable budget, so that frames
+#  used by several processing stages are only decoded once. Frames are kept
+#  as decoded (8 bit) and not as float, optionally compressed. If the budget
+#  is exceeded, the least recently used frames are evicted.
+class FrameCache:
+    
+    ## The constructor
+    #  @param max_bytes memory budget of the cache in bytes
+    #  @param compress if True, frames are stored zlib compressed. This needs
+    #  less memory, but costs some time for each access.
+    def __init__(self, max_bytes, compress=False):
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.frames = collections.OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        # the cache is shared by threads of the alignment and stacking stages
+        self.lock = threading.Lock()
+        
+    ## Get a frame from the cache or load it if it is not cached
+    #  @param key key identifying the frame, e.g. its path
+    #  @param load_function callable without parameters that returns the
+    #  decoded frame as numpy array
+    #  @return frame as read-only numpy array
+    def getFrame(self, key, load_function):
+        with self.lock:
+            entry = self.frames.get(key)
+            if entry is not None:
+                self.frames.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+                
+        if entry is not None:
+            return self.unpackFrame(entry)
+            
+        frame = load_function()
+        if frame is None:
+            return None
+        
+        # frames are shared, so nobody may change them
+        frame.flags.writeable = False
+        
+        entry = self.packFrame(frame)
+        entry_bytes = self.getEntryBytes(entry)
+        if entry_bytes <= self.max_bytes:
+            with self.lock:
+                if key not in self.frames:
+                    self.frames[key] = entry
+                    self.current_bytes += entry_bytes
+                    self.evict()
+                    
+        return frame
+        
+    ## remove the least recently used frames until the budget is met
+    def evict(self):
+        while self.current_bytes > self.max_bytes:
+            key, entry = self.frames.popitem(last=False)
+            self.current_bytes -= self.getEntryBytes(entry)
+            self.evictions += 1
+            
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.current_bytes = 0
+            
+    ## Get the counters of the cache, which are useful to find a budget
+    #  @return dictionary of {hits, misses, evictions, frames, bytes}
+    def getStatistics(self):
+        with self.lock:
+            return {"hits" : self.hits,
+                    "misses" : self.misses,
+                    "evictions" : self.evictions,
+                    "frames" : len(self.frames),
+                    "bytes" : self.current_bytes}
+        
+    def packFrame(self, frame):
+        if not self.compress:
+            return frame
+        data = zlib.compress(np.ascontiguousarray(frame).tobytes(), 1)
+        return (data, frame.shape, frame.dtype)
+        
+    def unpackFrame(self, entry):
+        if not self.compress:
+            return entry
+        data, shape, dtype = entry
+        frame = np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(shape)
+        return frame
+        
+    def getEntryBytes(self, entry):
+        if not self.compress:
+            return entry.nbytes
+        return len(entry[0])
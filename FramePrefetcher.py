@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import queue
+import threading
+
+## Loads frames in a background thread while the previous ones are processed.
+#  Iterating over the object yields tuples (index, frame) in the order of the
+#  given indices. At most queue_size frames are loaded in advance, so memory
+#  stays bounded.
+class FramePrefetcher:
+    
+    ## The constructor. The background thread is started immediately.
+    #  @param load_function callable that loads the frame with given index
+    #  @param indices iterable of the indices of the frames to load
+    #  @param queue_size number of frames that are loaded in advance
+    def __init__(self, load_function, indices, queue_size=1):
+        self.load_function = load_function
+        self.indices = list(indices)
+        self.frame_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        
+    def run(self):
+        for index in self.indices:
+            try:
+                item = (index, self.load_function(index), None)
+            except Exception as exception:
+                item = (index, None, exception)
+            if not self.putItem(item) or item[2] is not None:
+                return
+                
+    ## put an item into the queue unless the prefetcher is stopped
+    #  @return False if the prefetcher has been stopped
+    def putItem(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+        
+    def __iter__(self):
+        for count in range(len(self.indices)):
+            index, frame, exception = self.frame_queue.get()
+            if exception is not None:
+                raise exception
+            yield index, frame
+            
+    ## stop loading frames and wait for the background thread
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import concurrent.futures
+import os
+import cv2
+import numpy as np
+
+## Scores the sharpness of the raw frames and selects the best ones before
+#  they are aligned, so that motion blurred or misfocused frames neither cost
+#  time nor degrade the result.
+class FrameSelector:
+    
+    def __init__(self):
+        # "laplacian" scores by the variance of the Laplacian, "gradient" by
+        # the mean squared gradient magnitude
+        self.metric = "laplacian"
+        
+        # number of frames to keep. 0 keeps all frames.
+        self.keep_count = 0
+        
+        # fraction of the frames to keep. If both keep_count and
+        # keep_fraction are given, the smaller number of frames is kept.
+        self.keep_fraction = 1.
+        
+        # number of threads scoring frames. 0 uses all cores.
+        self.num_workers = 1
+        
+    ## @return True if frames are discarded at all
+    def isActive(self):
+        return self.keep_count > 0 or self.keep_fraction < 1.
+        
+    ## Score the sharpness of all frames of a dataset in parallel threads
+    #  @param dataset ImageDataHolder object
+    #  @param continue_processing list with one bool; processing is aborted if
+    #  it is set to False
+    #  @param status_callback callable that is called with a status string
+    #  @return list of scores in the order of the frames or "aborted"
+    def scoreFrames(self, dataset, continue_processing, status_callback):
+        num_images = dataset.getImageCount()
+        scores = [None] * num_images
+        num_workers = self.num_workers if self.num_workers > 0 else os.cpu_count()
+        
+        # OpenCV releases the GIL while decoding and filtering
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = {}
+            for index in range(num_images):
+                future = executor.submit(lambda index: self.calculateScore(dataset.getImage(index)),
+                                         index)
+                futures[future] = index
+                
+            counter = 0
+            for future in concurrent.futures.as_completed(futures):
+                if continue_processing[0] == False:
+                    for pending_future in futures:
+                        pending_future.cancel()
+                    return "aborted"
+                    
+                scores[futures[future]] = future.result()
+                
+                counter += 1
+                status_callback("scoring frames: " + str(counter) + " of "
+                                + str(num_images) + " done")
+                
+        return scores
+        
+    ## Calculate the sharpness score of a frame at its original resolution
+    #  @param image image as numpy array
+    #  @return score as float. Higher is sharper.
+    def calculateScore(self, image):
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        image = image.astype(np.float32)
+        
+        if self.metric == "gradient":
+            gradient_x = cv2.Sobel(image, cv2.CV_32F, 1, 0)
+            gradient_y = cv2.Sobel(image, cv2.CV_32F, 0, 1)
+            return float(np.mean(gradient_x * gradient_x + gradient_y * gradient_y))
+            
+        mean, standard_deviation = cv2.meanStdDev(cv2.Laplacian(image, cv2.CV_32F))
+        return float(standard_deviation[0, 0] ** 2)
+        
+    ## Select the best frames by their scores
+    #  @param scores list of scores as calculated by scoreFrames
+    #  @return list of the indices of the selected frames in their original
+    #  order, so that the first selected frame is the reference
+    def selectFrames(self, scores):
+        num_images = len(scores)
+        num_selected = num_images
+        if self.keep_count > 0:
+            num_selected = min(num_selected, self.keep_count)
+        if self.keep_fraction < 1.:
+            num_selected = min(num_selected, int(np.ceil(self.keep_fraction * num_images)))
+        num_selected = max(num_selected, 1)
+        
+        # stable sort, so that frames with equal scores keep their order
+        ranking = sorted(range(num_images), key=lambda index: -scores[index])
+        return sorted(ranking[:num_selected])
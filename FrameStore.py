@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import concurrent.futures
+import os
+import tempfile
+import numpy as np
+import CommonFunctions
+
+## Holds all frames of a burst decoded in a single memory mapped array of
+#  shape (frames, height, width, channels) in a scratch file, optionally
+#  together with a greyscale plane of shape (frames, height, width) for the
+#  alignment. Every frame is decoded only once. The frames are returned as
+#  read-only views without copying.
+#
+#  A FrameStore can be passed to worker processes. Only the path and the
+#  shape are pickled, and the worker maps the same file, so that all
+#  processes share the frames in the page cache instead of decoding or
+#  transferring them again.
+class FrameStore:
+
+    ## The constructor
+    #  @param image_paths list of paths of the frames
+    #  @param directory directory of the scratch files. None uses the default
+    #  temporary directory.
+    #  @param store_gray if True, a greyscale plane is stored as well
+    def __init__(self, image_paths, directory=None, store_gray=False):
+        self.image_paths = image_paths
+        self.directory = directory
+        self.store_gray = store_gray
+
+        # number of threads decoding the frames. 0 uses all cores.
+        self.num_workers = 1
+
+        self.frames_path = None
+        self.gray_frames_path = None
+        self.shape = None
+        self.dtype = None
+        self.frames = None
+        self.gray_frames = None
+
+        # only the process that has created the files deletes them
+        self.bool_owner = False
+
+    # the worker processes map the files themselves
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["frames"] = None
+        state["gray_frames"] = None
+        state["bool_owner"] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.frames_path is not None:
+            self.openFiles()
+
+    ## Decode all frames into the scratch files
+    #  @param load_function callable that takes the index of a frame and
+    #  returns the decoded frame as numpy array or None, e.g.
+    #  ImageDataHolder.getImage, which reuses frames from a frame cache
+    #  @param continue_processing list with one bool; processing is aborted if
+    #  it is set to False
+    #  @param status_callback callable that is called with a status string
+    #  @return "aborted" if aborted, else None
+    def ingest(self, load_function, continue_processing, status_callback):
+        num_images = len(self.image_paths)
+        first_image = self.loadImage(load_function, 0)
+        self.shape = first_image.shape
+        self.dtype = first_image.dtype
+        self.createFiles()
+        self.storeImage(0, first_image)
+        del first_image
+
+        num_workers = self.num_workers if self.num_workers > 0 else os.cpu_count()
+
+        # OpenCV releases the GIL while decoding
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = {}
+            for index in range(1, num_images):
+                future = executor.submit(lambda index: self.storeImage(index,
+                                                                       self.loadImage(load_function, index)),
+                                         index)
+                futures[future] = index
+
+            counter = 1
+            for future in concurrent.futures.as_completed(futures):
+                if continue_processing[0] == False:
+                    for pending_future in futures:
+                        pending_future.cancel()
+                    return "aborted"
+
+                future.result()
+
+                counter += 1
+                status_callback("decoding frames: " + str(counter) + " of "
+                                + str(num_images) + " done")
+
+        self.frames.flush()
+        if self.gray_frames is not None:
+            self.gray_frames.flush()
+
+    ## Load a frame and check that it fits into the store
+    #  @param load_function callable that loads a frame by its index
+    #  @param index index of the frame
+    #  @return decoded frame as numpy array
+    def loadImage(self, load_function, index):
+        image = load_function(index)
+        if image is None:
+            raise ValueError("could not read " + self.image_paths[index])
+        if self.shape is not None and image.shape != self.shape:
+            raise ValueError(self.image_paths[index] + " has shape " + str(image.shape)
+                             + " instead of " + str(self.shape))
+        return image
+
+    def storeImage(self, index, image):
+        self.frames[index] = image
+        if self.gray_frames is not None:
+            self.gray_frames[index] = CommonFunctions.convertToGray(image)
+
+    ## Create the scratch files and map them
+    def createFiles(self):
+        num_images = len(self.image_paths)
+        self.frames_path = self.createFile(".frames")
+        self.frames = np.memmap(self.frames_path, dtype=self.dtype, mode="w+",
+                                shape=(num_images,) + tuple(self.shape))
+        if self.store_gray:
+            self.gray_frames_path = self.createFile(".gray")
+            self.gray_frames = np.memmap(self.gray_frames_path, dtype=self.dtype, mode="w+",
+                                         shape=(num_images,) + tuple(self.shape[:2]))
+        self.bool_owner = True
+
+    def createFile(self, suffix):
+        file_descriptor, path = tempfile.mkstemp(prefix="verysharp_", suffix=suffix,
+                                                 dir=self.directory)
+        os.close(file_descriptor)
+        return path
+
+    ## Map the existing scratch files read-only, e.g. in a worker process
+    def openFiles(self):
+        num_images = len(self.image_paths)
+        self.frames = np.memmap(self.frames_path, dtype=self.dtype, mode="r",
+                                shape=(num_images,) + tuple(self.shape))
+        if self.gray_frames_path is not None:
+            self.gray_frames = np.memmap(self.gray_frames_path, dtype=self.dtype, mode="r",
+                                         shape=(num_images,) + tuple(self.shape[:2]))
+
+    def getImageCount(self):
+        return len(self.image_paths)
+
+    ## Get a frame
+    #  @param index index of the frame
+    #  @return read-only view of the frame
+    def getFrame(self, index):
+        frame = self.frames[index]
+        frame.flags.writeable = False
+        return frame
+
+    ## Get the frame used for the alignment, which is the greyscale plane if
+    #  it is stored
+    #  @param index index of the frame
+    #  @return read-only view of the frame
+    def getAlignmentFrame(self, index):
+        if self.gray_frames is None:
+            return self.getFrame(index)
+        frame = self.gray_frames[index]
+        frame.flags.writeable = False
+        return frame
+
+    ## Unmap the frames and delete the scratch files, if they have been
+    #  created by this process
+    def close(self):
+        self.frames = None
+        self.gray_frames = None
+        if self.bool_owner:
+            for path in (self.frames_path, self.gray_frames_path):
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+            self.bool_owner = False
+        self.frames_path = None
+        self.gray_frames_path = None
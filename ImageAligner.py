@@ -17,34 +17,324 @@
     along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import concurrent.futures
+import os
+import signal
 import cv2
 import numpy as np
 import CommonFunctions
+import Instrumentation
+
+# aligner used by the worker processes of the parallel alignment. It is set
+# once per process by initializeWorker, so that the reference image is only
+# transferred and upscaled once per worker.
+_worker_image_aligner = None
+
+# FrameStore the workers read the images from, or None if they decode the
+# images themselves
+_worker_frame_store = None
+
+## Initialize a worker process for parallel alignment
+#  @param image_aligner ImageAligner object without reference
+#  @param reference_image the raw reference image as numpy array. Ignored if
+#  a frame store is given.
+#  @param tiles list of tiles as calculated by ImageStacker.calculateTiles
+#  @param frame_store FrameStore object holding the images, or None. The
+#  workers map its file, so that the images are neither decoded again nor
+#  transferred to the workers.
+#  @param textured_tiles tiles to align as calculated by
+#  ImageAligner.calculateTexturedTiles in the main process
+def initializeWorker(image_aligner, reference_image, tiles, frame_store=None,
+                     textured_tiles=None):
+    global _worker_image_aligner, _worker_frame_store
+    
+    # with the fork start method, the workers inherit the handler of the
+    # main process, which would abort a copy of the run that does nothing.
+    # Only the main process handles the abort.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    
+    _worker_image_aligner = image_aligner
+    _worker_frame_store = frame_store
+    if frame_store is not None:
+        reference_image = frame_store.getAlignmentFrame(0)
+    
+    # with the fork start method, the aligner is not pickled and would
+    # still write to the sinks of the main process
+    _worker_image_aligner.instrumentation = Instrumentation.Instrumentation()
+    
+    # the images a worker aligns do not follow each other, so the motion
+    # cannot be predicted from them
+    _worker_image_aligner.temporal_prediction = "none"
+    _worker_image_aligner.setReference(reference_image, tiles, bool_plan_tiles=False)
+    _worker_image_aligner.textured_tiles = textured_tiles
+
+## Align an image in a worker process
+#  @param image_path path of the image to align
+#  @param index index of the image in the frame store, if there is one
+#  @return tuple (list of transform matrices, list of correlation
+#  coefficients), one of each for each tile
+def alignImageInWorker(image_path, index=None):
+    if _worker_frame_store is not None:
+        image = _worker_frame_store.getAlignmentFrame(index)
+    else:
+        image = cv2.imread(image_path)
+    return _worker_image_aligner.alignImage(image, [True], None)
 
 class ImageAligner:
     
     ## The constructor
-    #  @param reference_image the reference Image as float numpy array
+    #  @param scale_factor factor by which the images are upscaled
     def __init__(self, scale_factor):
         self.scale_factor = scale_factor
         self.motion_type = cv2.MOTION_AFFINE
         
+        # Specify the number of iterations for ECC alignment.
+        self.number_of_iterations = 500
+        
+        # Specify the threshold of the increment
+        # in the correlation coefficient between two iterations
+        self.termination_eps = 1e-5
+        
+        # number of processes aligning images in parallel. 1 aligns in the
+        # calling process, 0 uses one process per cpu core.
+        self.num_workers = 1
+        
+        # number of threads aligning the tiles of one image in parallel.
+        # 1 aligns the tiles one after another, 0 uses one thread per cpu core.
+        self.num_tile_threads = 1
+        
+        # "ecc" runs ECC on the full upscaled tiles. "pyramid" estimates the
+        # transformation on downsampled tiles coarse to fine and refines it
+        # with a few ECC iterations on the upscaled tiles.
+        self.alignment_method = "ecc"
+        
+        # number of pyramid levels below the upscaled resolution. Each level
+        # halves the resolution, so with a scale factor of 2, level 1 has
+        # the resolution of the raw images.
+        self.pyramid_levels = 3
+        
+        # maximum number of ECC iterations on each of the coarse levels
+        self.pyramid_iterations = 50
+        
+        # iterations and threshold of the increment in the correlation
+        # coefficient for the refinement on the upscaled tiles. These
+        # control the final sub-pixel accuracy of the pyramid alignment.
+        self.refinement_iterations = 10
+        self.refinement_eps = 1e-4
+        
+        # initial estimate for ECC. "phase_correlation" estimates the
+        # translation of each tile by FFT phase correlation with cached
+        # spectra of the reference tiles. "feature" uses
+        # cv2.estimateRigidTransform, which is only available in OpenCV < 4;
+        # phase correlation is used instead if it is missing.
+        self.initial_estimate = "phase_correlation"
+        
+        # if True, phase correlation additionally estimates the rotation of
+        # each tile by log-polar correlation of the magnitude spectra
+        self.estimate_rotation = False
+        
+        # phase correlation results with a lower peak are discarded
+        self.phase_correlation_min_response = 0.02
+        
+        # tiles of the reference image with less texture, like blank sky or
+        # out of focus background, are not aligned. Their transforms are
+        # interpolated from the aligned tiles instead. The texture is the
+        # mean of the smaller eigenvalue of the structure tensor of the
+        # upscaled tile, which is only large where there are gradients in two
+        # directions, so that ECC can lock on. Noise with a standard deviation
+        # of 2 gives about 0.3. 0 aligns all tiles.
+        self.min_tile_texture = 0.
+        
+        # ECC of each tile starts from the transform predicted from the
+        # previous images, which drift smoothly in a handheld burst. From the
+        # prediction, only refinement_iterations iterations are run.
+        # "previous" uses the transform of the tile in the previous image,
+        # "linear" extrapolates the transforms of the last two images. If the
+        # correlation coefficient is more than warm_start_tolerance below
+        # the one of the tile in the previous image, the tile is aligned
+        # from the initial estimate as usual and the better result is kept.
+        # In pyramid mode, a good prediction only needs the refinement on the
+        # upscaled tile. "none" aligns every image from scratch. The
+        # prediction is only used if the images are aligned in order, so not
+        # with multiple worker processes.
+        self.temporal_prediction = "none"
+        self.warm_start_tolerance = 0.02
+        
+        self.reference_image = None
+        self.reference_pyramids = None
+        self.reference_spectra = None
+        self.tiles = None
+        
+        # for each tile, whether it is aligned or interpolated. None if all
+        # tiles are aligned.
+        self.textured_tiles = None
+        
+        # transform matrices and correlation coefficients of the tiles of the
+        # last two aligned images, the latest last
+        self.transform_matrix_history = []
+        self.correlation_coefficient_history = []
+        
+        # records the times of the alignment of each image and tile
+        self.instrumentation = Instrumentation.Instrumentation()
+        
+    ## Get all parameters the resulting transform matrices depend on, e.g.
+    #  for caching them. The number of workers and threads is not included,
+    #  as it does not change the result. Only the temporal prediction is off
+    #  with multiple workers, so the prediction that is actually used is
+    #  included.
+    #  @return dictionary of parameter names and values
+    def getParameters(self):
+        return {"scale_factor" : self.scale_factor,
+                "motion_type" : self.motion_type,
+                "number_of_iterations" : self.number_of_iterations,
+                "termination_eps" : self.termination_eps,
+                "alignment_method" : self.alignment_method,
+                "pyramid_levels" : self.pyramid_levels,
+                "pyramid_iterations" : self.pyramid_iterations,
+                "refinement_iterations" : self.refinement_iterations,
+                "refinement_eps" : self.refinement_eps,
+                "initial_estimate" : self.initial_estimate,
+                "estimate_rotation" : self.estimate_rotation,
+                "phase_correlation_min_response" : self.phase_correlation_min_response,
+                "min_tile_texture" : self.min_tile_texture,
+                "temporal_prediction" : self.getEffectiveTemporalPrediction(),
+                "warm_start_tolerance" : self.warm_start_tolerance}
+        
+    # the upscaled reference image is not needed by the worker processes
+    # because they calculate it themselves
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["reference_image"] = None
+        state["reference_pyramids"] = None
+        state["reference_spectra"] = None
+        state["textured_tiles"] = None
+        return state
+        
+    ## Get the temporal prediction that is used with the current number of
+    #  workers. The images a worker aligns do not follow each other, so
+    #  there is no prediction with multiple workers.
+    #  @return "none", "previous" or "linear"
+    def getEffectiveTemporalPrediction(self):
+        num_workers = self.num_workers if self.num_workers > 0 else os.cpu_count()
+        if num_workers > 1:
+            return "none"
+        return self.temporal_prediction
+        
+    ## Set the reference image all other images are aligned to
+    #  @param reference_image the raw reference image as numpy array
+    #  @param tiles list of tiles as calculated by ImageStacker.calculateTiles
+    #  @param bool_plan_tiles if False, the tiles to align are not chosen,
+    #  e.g. in worker processes, which get them from the main process
+    def setReference(self, reference_image, tiles, bool_plan_tiles=True):
+        reference_image = self.upscaleReference(reference_image)
+        self.setUpscaledReference(reference_image, tiles, bool_plan_tiles)
+        
+    ## Upscale a reference image for the alignment
+    #  @param reference_image the raw reference image as numpy array
+    #  @return upscaled reference image as 8 bit numpy array
+    def upscaleReference(self, reference_image):
+        return CommonFunctions.preprocessImage(reference_image,
+                                               self.scale_factor,
+                                               data_type=np.uint8,
+                                               interpolation=cv2.INTER_CUBIC)
+        
+    ## Set the reference image all other images are aligned to
+    #  @param reference_image the upscaled reference image as 8 bit numpy array
+    #  @param tiles list of tiles as calculated by ImageStacker.calculateTiles
+    #  @param bool_plan_tiles if False, the tiles to align are not chosen
+    def setUpscaledReference(self, reference_image, tiles, bool_plan_tiles=True):
+        self.reference_image = reference_image
+        self.tiles = tiles
+        self.transform_matrix_history = []
+        self.correlation_coefficient_history = []
+        
+        # the tiles to align are chosen once from the reference
+        self.textured_tiles = None
+        if bool_plan_tiles:
+            self.textured_tiles = self.calculateTexturedTiles(reference_image, tiles)
+        
+        # the pyramids and spectra of the reference tiles are the same for all
+        # images, so they are only calculated once
+        self.reference_pyramids = None
+        if self.alignment_method == "pyramid":
+            self.reference_pyramids = []
+            for tile in tiles:
+                tile_slice = np.s_[tile["y"][0]:tile["y"][1],tile["x"][0]:tile["x"][1]]
+                reference_tile_C1 = CommonFunctions.convertToGray(reference_image[tile_slice])
+                self.reference_pyramids.append(self.buildPyramid(reference_tile_C1))
+                
+        self.reference_spectra = None
+        if self.usePhaseCorrelation():
+            self.reference_spectra = []
+            for tile_index, tile in enumerate(tiles):
+                # the pyramid alignment starts on the coarsest level
+                if self.reference_pyramids is not None:
+                    reference_tile_C1 = self.reference_pyramids[tile_index][-1]
+                else:
+                    tile_slice = np.s_[tile["y"][0]:tile["y"][1],tile["x"][0]:tile["x"][1]]
+                    reference_tile_C1 = CommonFunctions.convertToGray(reference_image[tile_slice])
+                self.reference_spectra.append(self.calculateReferenceSpectra(reference_tile_C1))
+        
+    ## Choose the tiles to align from the texture of the reference tiles and
+    #  report how many there are
+    #  @param reference_image the upscaled reference image as 8 bit numpy array
+    #  @param tiles list of tiles as calculated by ImageStacker.calculateTiles
+    #  @return list with a bool for each tile, which is True if the tile is
+    #  aligned, or None if all tiles are aligned
+    def calculateTexturedTiles(self, reference_image, tiles):
+        if self.min_tile_texture <= 0.:
+            return None
+        textured_tiles = []
+        for tile in tiles:
+            tile_slice = np.s_[tile["y"][0]:tile["y"][1],tile["x"][0]:tile["x"][1]]
+            reference_tile_C1 = CommonFunctions.convertToGray(reference_image[tile_slice])
+            textured_tiles.append(self.calculateTexture(reference_tile_C1) >= self.min_tile_texture)
+            
+        print ("aligning ", sum(textured_tiles), " of ", len(tiles), " tiles with texture")
+        self.instrumentation.recordEvent("tile_plan",
+                                         num_tiles=len(tiles),
+                                         num_textured_tiles=sum(textured_tiles))
+        
+        # without any texture, aligning all tiles is the best that can be
+        # done
+        if 0 < sum(textured_tiles) < len(tiles):
+            return textured_tiles
+        return None
+        
     ## Calculate the Transformation matrices for all images in the dataset
     #  @param dataset ImageDataHolder object with filled hdulists and empty 
-    #  transform matrices
+    #  transform matrices. Images that already have transform matrices, e.g.
+    #  from a checkpoint, are skipped.
+    #  @param tiles list of tiles as calculated by ImageStacker.calculateTiles
+    #  @param continue_processing list containing one bool; processing is
+    #  aborted if it is set to False
+    #  @param status_callback callable that is called with a status string
+    #  @param image_aligned_callback callable that is called with the index
+    #  of each image after its transform matrices have been filled in, or None
     #  @return dataset with filled tansform_matrices for upscaled images
-    def calculateTransformationMatrices(self, dataset, tiles, continue_processing, signal_status_update):
+    def calculateTransformationMatrices(self, dataset, tiles, continue_processing, status_callback,
+                                        image_aligned_callback=None):
         # fill unity matrix for first image
-        for tile in tiles:
-            unity_transform_matrix = np.eye(2, 3, dtype=np.float32)
-            dataset.appendTransformMatrix(0, unity_transform_matrix)  #@todo: is this possible inplace?
+        if not dataset.transform_matrices[0]:
+            for tile in tiles:
+                unity_transform_matrix = np.eye(2, 3, dtype=np.float32)
+                dataset.appendTransformMatrix(0, unity_transform_matrix)  #@todo: is this possible inplace?
+                dataset.appendCorrelationCoefficient(0, 1.)
         
         # set the first image as reference
-        first_data = dataset.getData(0)
-        reference_image = CommonFunctions.preprocessImage(first_data["image"],
-                                                          self.scale_factor,
-                                                          data_type=np.uint8,
-                                                          interpolation=cv2.INTER_CUBIC)
+        reference_image = dataset.getAlignmentImage(0)
+        
+        num_workers = self.num_workers if self.num_workers > 0 else os.cpu_count()
+        if num_workers > 1:
+            return self.calculateTransformationMatricesParallel(dataset,
+                                                                reference_image,
+                                                                tiles,
+                                                                num_workers,
+                                                                continue_processing,
+                                                                status_callback,
+                                                                image_aligned_callback)
+        
+        self.setReference(reference_image, tiles)
     
         # iterate through the dataset and create the tansformation matrix for each.
         # except the first one
@@ -54,82 +344,661 @@ class ImageAligner:
             if continue_processing[0] == False:
                 return "aborted"
             
+            if dataset.transform_matrices[index]:
+                # aligned before, e.g. restored from a checkpoint
+                self.updateHistory(dataset.transform_matrices[index],
+                                   dataset.correlation_coefficients[index])
+                continue
+            
             print ("calculating transformation map for alignment of image ", index + 1)      
             
             # Get the image at the index
-            data = dataset.getData(index)
-            image = CommonFunctions.preprocessImage(data["image"],
+            image = dataset.getAlignmentImage(index)
+            
+            status_prefix = ("aligning image " 
+                             + str(index + 1) 
+                             + " of " 
+                             + str(num_images)
+                             + ": ")
+            tile_status_callback = lambda status: status_callback(status_prefix + status)
+            with self.instrumentation.measure("align", image=index):
+                alignment_result = self.alignImage(image,
+                                                   continue_processing,
+                                                   tile_status_callback)
+            if alignment_result == "aborted":
+                return "aborted"
+            
+            # fill the warp matrices into the dataset
+            transform_matrices, correlation_coefficients = alignment_result
+            for transform_matrix in transform_matrices:
+                dataset.appendTransformMatrix(index, transform_matrix)
+            for correlation_coefficient in correlation_coefficients:
+                dataset.appendCorrelationCoefficient(index, correlation_coefficient)
+            if image_aligned_callback is not None:
+                image_aligned_callback(index)
+            
+        return dataset
+        
+    ## Calculate the Transformation matrices for all images in the dataset
+    #  using a pool of worker processes that align one image each.
+    #  Parameters are the same as for calculateTransformationMatrices.
+    #  @param reference_image the raw reference image as numpy array
+    #  @param num_workers number of worker processes
+    #  @return dataset with filled tansform_matrices for upscaled images
+    def calculateTransformationMatricesParallel(self, dataset, reference_image, tiles,
+                                                num_workers, continue_processing,
+                                                status_callback, image_aligned_callback=None):
+        num_images = dataset.getImageCount()
+        
+        # the tiles to align are chosen once here instead of in every worker
+        textured_tiles = None
+        if self.min_tile_texture > 0.:
+            textured_tiles = self.calculateTexturedTiles(self.upscaleReference(reference_image),
+                                                         tiles)
+        
+        # with a frame store, the workers read the reference themselves
+        frame_store = dataset.frame_store
+        if frame_store is not None:
+            reference_image = None
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers,
+                                                          initializer=initializeWorker,
+                                                          initargs=(self, reference_image, tiles,
+                                                                    frame_store, textured_tiles))
+        futures = {}
+        for index in range(1, num_images):
+            if dataset.transform_matrices[index]:
+                continue
+            future = executor.submit(alignImageInWorker, dataset.image_paths[index], index)
+            futures[future] = index
+            
+        num_done = 0
+        pending = set(futures)
+        try:
+            while pending:
+                if continue_processing[0] == False:
+                    return "aborted"
+                    
+                done, pending = concurrent.futures.wait(pending,
+                                                        timeout=0.5,
+                                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    # fill the warp matrices into the dataset right away, so
+                    # that they are available to image_aligned_callback
+                    index = futures[future]
+                    try:
+                        transform_matrices, correlation_coefficients = future.result()
+                    except concurrent.futures.process.BrokenProcessPool:
+                        # the workers are terminated together with the main
+                        # process, e.g. by a SIGTERM to the process group,
+                        # whose handler has aborted the run
+                        if continue_processing[0] == False:
+                            return "aborted"
+                        raise
+                    for transform_matrix in transform_matrices:
+                        dataset.appendTransformMatrix(index, transform_matrix)
+                    for correlation_coefficient in correlation_coefficients:
+                        dataset.appendCorrelationCoefficient(index, correlation_coefficient)
+                    num_done += 1
+                    if image_aligned_callback is not None:
+                        image_aligned_callback(index)
+                    
+                status = ("aligning images: "
+                          + str(num_done)
+                          + " of "
+                          + str(len(futures))
+                          + " done")
+                status_callback(status)
+        finally:
+            # do not wait for running workers if aborted
+            executor.shutdown(wait=continue_processing[0], cancel_futures=True)
+                
+        return dataset
+        
+    ## Calculate the transformation matrices of all tiles of an image relative
+    #  to the reference image
+    #  @param image the raw image as numpy array
+    #  @param continue_processing list containing one bool; processing is
+    #  aborted if it is set to False
+    #  @param status_callback callable that is called with a status string.
+    #  May be None.
+    #  @return tuple (list of transform matrices, list of correlation
+    #  coefficients), one of each for each tile, or "aborted"
+    def alignImage(self, image, continue_processing, status_callback):
+        with self.instrumentation.measure("upscale"):
+            image = CommonFunctions.preprocessImage(image,
                                                     self.scale_factor,
                                                     data_type=np.uint8,
                                                     interpolation=cv2.INTER_CUBIC)
+        return self.alignUpscaledImage(image, continue_processing, status_callback)
+        
+    ## Calculate the transformation matrices of all tiles of an image relative
+    #  to the reference image
+    #  @param image the upscaled image as 8 bit numpy array
+    #  @param continue_processing list containing one bool; processing is
+    #  aborted if it is set to False
+    #  @param status_callback callable that is called with a status string.
+    #  May be None.
+    #  @return tuple (list of transform matrices, list of correlation
+    #  coefficients), one of each for each tile, or "aborted". The correlation
+    #  coefficient of the ECC alignment is None for failed tiles.
+    def alignUpscaledImage(self, image, continue_processing, status_callback):
+        num_tile_threads = self.num_tile_threads if self.num_tile_threads > 0 else os.cpu_count()
+        if num_tile_threads > 1:
+            tile_results = self.alignTilesParallel(image,
+                                                   num_tile_threads,
+                                                   continue_processing,
+                                                   status_callback)
+        else:
+            tile_results = self.alignTilesSerial(image,
+                                                 continue_processing,
+                                                 status_callback)
+        if tile_results == "aborted":
+            return "aborted"
+        
+        if self.textured_tiles is not None:
+            tile_results = self.interpolateSkippedTiles(tile_results)
+        
+        # resolve the failed tiles after all tiles are finished, so that the
+        # result does not depend on the order in which tiles have finished
+        transform_matrices = []
+        correlation_coefficients = []
+        previous_transform_matrix = np.eye(2,3, dtype=np.float32)
+        for tile_index, (transform_matrix, correlation_coefficient) in enumerate(tile_results):
+            correlation_coefficients.append(correlation_coefficient)
             
-            previous_transform_matrix = np.eye(2,3, dtype=np.float32)
+            # if the alignment has failed, use the matrix of the previous tile
+            if transform_matrix is None:
+                self.instrumentation.recordEvent("tile_fallback", tile=tile_index)
+                transform_matrix = previous_transform_matrix
             
-            counter = 0
-            for tile in tiles:
+            transform_matrices.append(transform_matrix)
+            
+            # if next tile fails, use this one instead
+            previous_transform_matrix = transform_matrix
+            
+        self.updateHistory(transform_matrices, correlation_coefficients)
+        return transform_matrices, correlation_coefficients
+        
+    ## Remember the result of an image for predicting the transforms of the
+    #  next one
+    #  @param transform_matrices list of transform matrices of the tiles
+    #  @param correlation_coefficients list of correlation coefficients of
+    #  the tiles
+    def updateHistory(self, transform_matrices, correlation_coefficients):
+        if self.temporal_prediction == "none":
+            return
+        self.transform_matrix_history = self.transform_matrix_history[-1:] + [transform_matrices]
+        self.correlation_coefficient_history = (self.correlation_coefficient_history[-1:]
+                                                + [correlation_coefficients])
+        
+    ## Predict the transform matrix of a tile from the previous images
+    #  @param tile_index index of the tile in self.tiles
+    #  @return tuple (predicted transform matrix as float32 numpy array,
+    #  correlation coefficient of the tile in the previous image), or None if
+    #  there is no prediction, e.g. because the alignment of the tile has
+    #  failed in the previous image
+    def predictTransformMatrix(self, tile_index):
+        if self.temporal_prediction == "none" or not self.transform_matrix_history:
+            return None
+        previous_correlation_coefficient = self.correlation_coefficient_history[-1][tile_index]
+        if previous_correlation_coefficient is None:
+            return None
+        
+        predicted_transform_matrix = self.transform_matrix_history[-1][tile_index]
+        if self.temporal_prediction == "linear" and len(self.transform_matrix_history) > 1:
+            predicted_transform_matrix = (2. * predicted_transform_matrix
+                                          - self.transform_matrix_history[-2][tile_index])
+        return predicted_transform_matrix.astype(np.float32), previous_correlation_coefficient
+        
+    ## Align all tiles of an upscaled image one after another
+    #  @param image the upscaled image as 8 bit numpy array
+    #  @param continue_processing list containing one bool; processing is
+    #  aborted if it is set to False
+    #  @param status_callback callable that is called with a status string.
+    #  May be None.
+    #  @return list with a tuple (transform matrix or None, correlation
+    #  coefficient or None) for each tile, or "aborted"
+    def alignTilesSerial(self, image, continue_processing, status_callback):
+        tile_results = []
+        
+        for tile_index in range(len(self.tiles)):
+            
+            if continue_processing[0] == False:
+                return "aborted"
+                
+            if status_callback is not None:
+                percentage_finished = round(100. * float(tile_index) / float(len(self.tiles)))
+                status_callback(str(percentage_finished) + "%")
+            
+            if not self.isTileAligned(tile_index):
+                tile_results.append((None, None))
+                continue
+            
+            tile_results.append(self.alignImageTile(image, tile_index))
+            
+        return tile_results
+        
+    ## Align all tiles of an upscaled image at once using a thread pool.
+    #  OpenCV releases the GIL, so the tiles are processed in parallel.
+    #  @param image the upscaled image as 8 bit numpy array
+    #  @param num_threads number of threads
+    #  @param continue_processing list containing one bool; processing is
+    #  aborted if it is set to False
+    #  @param status_callback callable that is called with a status string.
+    #  May be None.
+    #  @return list with a tuple (transform matrix or None, correlation
+    #  coefficient or None) for each tile, or "aborted"
+    def alignTilesParallel(self, image, num_threads, continue_processing, status_callback):
+        tile_results = [(None, None)] * len(self.tiles)
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = {}
+            for tile_index in range(len(self.tiles)):
+                if not self.isTileAligned(tile_index):
+                    continue
+                future = executor.submit(self.alignImageTile, image, tile_index)
+                futures[future] = tile_index
                 
+            counter = 0
+            for future in concurrent.futures.as_completed(futures):
                 if continue_processing[0] == False:
+                    for pending_future in futures:
+                        pending_future.cancel()
                     return "aborted"
                     
-                percentage_finished = round(100. * float(counter) / float(len(tiles)))
-                status = ("aligning image " 
-                          + str(index + 1) 
-                          + " of " 
-                          + str(num_images)
-                          + ": "
-                          + str(percentage_finished)
-                          + "%")
-                signal_status_update.emit(status)
-                counter += 1
-                
-                tile_slice = np.s_[tile["y"][0]:tile["y"][1],tile["x"][0]:tile["x"][1]]
-#                print (tile_slice)
-#                print(image.shape)
-#                print(reference_image.shape)
-                reference_tile = reference_image[tile_slice]
-                image_tile = image[tile_slice]
-            
-                # convert image to 8u and greyscale for alignment functions
-                image_tile_C1 = cv2.cvtColor(image_tile, cv2.COLOR_BGR2GRAY)
-                reference_tile_C1 = cv2.cvtColor(reference_tile, cv2.COLOR_BGR2GRAY)
-                
-                # rough inital alignment using feature detection
-                warp_matrix = cv2.estimateRigidTransform(reference_tile, image_tile, False)
-                
-                # if estimateRigidTransform has failed, create unity matrix
-                if warp_matrix is None:
-                    print ("WARNING: Initial alignment for Image ", index + 1, " failed!")
-                    warp_matrix = np.eye(2,3, dtype=np.float32)
+                tile_results[futures[future]] = future.result()
                 
-                # convert warp matrix to float32 because findTransformECC needs this            
-                warp_matrix = warp_matrix.astype(np.float32)   
-                
-                # @todo: those two parameters can be set in config!
-                # Specify the number of iterations for ECC alignment.
-                number_of_iterations = 500;
-                 
-                # Specify the threshold of the increment
-                # in the correlation coefficient between two iterations
-                termination_eps = 1e-5;
-                
-                # Define termination criteria
-                criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
-                            number_of_iterations,  termination_eps)
+                counter += 1
+                if status_callback is not None:
+                    percentage_finished = round(100. * float(counter) / float(len(futures)))
+                    status_callback(str(percentage_finished) + "%")
+                    
+        return tile_results
+        
+    ## Check whether a tile is aligned or interpolated
+    #  @param tile_index index of the tile in self.tiles
+    #  @return True if the tile is aligned
+    def isTileAligned(self, tile_index):
+        return self.textured_tiles is None or self.textured_tiles[tile_index]
+        
+    ## Calculate the amount of texture of a tile, which is the mean of the
+    #  smaller eigenvalue of the structure tensor
+    #  @param image_C1 greyscale tile as numpy array
+    #  @return texture as float
+    def calculateTexture(self, image_C1):
+        image_C1 = image_C1.astype(np.float32)
+        gradient_x = cv2.Sobel(image_C1, cv2.CV_32F, 1, 0, ksize=3, scale=1. / 8.)
+        gradient_y = cv2.Sobel(image_C1, cv2.CV_32F, 0, 1, ksize=3, scale=1. / 8.)
+        
+        # structure tensor [[a, b], [b, c]] averaged over small windows
+        window_size = (7, 7)
+        a = cv2.boxFilter(gradient_x * gradient_x, -1, window_size)
+        b = cv2.boxFilter(gradient_x * gradient_y, -1, window_size)
+        c = cv2.boxFilter(gradient_y * gradient_y, -1, window_size)
+        min_eigenvalues = (a + c) / 2. - np.sqrt(np.square((a - c) / 2.) + np.square(b))
+        return float(np.mean(min_eigenvalues))
+        
+    ## Interpolate the transforms of the tiles that are not aligned. The
+    #  transforms of the aligned tiles are converted to coordinates of the
+    #  whole image and weighted by the inverse squared distance of the tile
+    #  centers.
+    #  @param tile_results list with a tuple (transform matrix or None,
+    #  correlation coefficient or None) for each tile
+    #  @return list of tile results with the interpolated transform matrices
+    #  filled in. Their correlation coefficient is None.
+    def interpolateSkippedTiles(self, tile_results):
+        def calculateCenter(tile):
+            return np.array([(tile["x"][0] + tile["margin_x"][0] + tile["x"][1] - tile["margin_x"][1] - 1) / 2.,
+                             (tile["y"][0] + tile["margin_y"][0] + tile["y"][1] - tile["margin_y"][1] - 1) / 2.])
+        
+        centers = []
+        transform_matrices_image = []
+        for tile_index, (transform_matrix, correlation_coefficient) in enumerate(tile_results):
+            if self.isTileAligned(tile_index) and transform_matrix is not None:
+                tile = self.tiles[tile_index]
+                centers.append(calculateCenter(tile))
+                transform_matrices_image.append(CommonFunctions.convertTransformMatrix(transform_matrix,
+                                                                                       1.,
+                                                                                       [tile["x"][0], tile["y"][0]]))
+        # if all alignments have failed, the skipped tiles fail too
+        if not centers:
+            return tile_results
+        centers = np.array(centers)
+        transform_matrices_image = np.array(transform_matrices_image, dtype=np.float64)
+        
+        tile_results = list(tile_results)
+        for tile_index, tile in enumerate(self.tiles):
+            if self.isTileAligned(tile_index):
+                continue
+            squared_distances = np.sum(np.square(centers - calculateCenter(tile)), axis=1)
+            weights = 1. / np.maximum(squared_distances, 1.)
+            transform_matrix_image = np.tensordot(weights / weights.sum(), transform_matrices_image, axes=1)
+            transform_matrix = CommonFunctions.convertTransformMatrix(transform_matrix_image,
+                                                                      1.,
+                                                                      [-tile["x"][0], -tile["y"][0]])
+            tile_results[tile_index] = (transform_matrix, None)
+        return tile_results
+        
+    ## Align one tile of an upscaled image to the reference image
+    #  @param image the upscaled image as 8 bit numpy array
+    #  @param tile_index index of the tile in self.tiles
+    #  @return tuple (transform matrix as float32 numpy array, correlation
+    #  coefficient). Both are None if the alignment has failed.
+    def alignImageTile(self, image, tile_index):
+        tile = self.tiles[tile_index]
+        tile_slice = np.s_[tile["y"][0]:tile["y"][1],tile["x"][0]:tile["x"][1]]
+        with self.instrumentation.measure("ecc_tile", tile=tile_index) as fields:
+            if self.alignment_method == "pyramid":
+                tile_result = self.alignTilePyramid(self.reference_pyramids[tile_index],
+                                                    image[tile_slice],
+                                                    tile_index)
+            else:
+                tile_result = self.alignTile(self.reference_image[tile_slice],
+                                             image[tile_slice],
+                                             tile_index)
+            fields["cc"] = tile_result[1]
+        return tile_result
+        
+    ## Calculate the transformation matrix of one tile
+    #  @param reference_tile tile of the upscaled reference image as 8 bit BGR
+    #  @param image_tile tile of the upscaled image as 8 bit BGR
+    #  @param tile_index index of the tile in self.tiles
+    #  @return tuple (transform matrix as float32 numpy array, correlation
+    #  coefficient). Both are None if the alignment has failed.
+    def alignTile(self, reference_tile, image_tile, tile_index):
+        # convert image to 8u and greyscale for alignment functions
+        image_tile_C1 = CommonFunctions.convertToGray(image_tile)
+        reference_tile_C1 = CommonFunctions.convertToGray(reference_tile)
+        
+        # Define termination criteria
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                    self.number_of_iterations, self.termination_eps)
+        
+        # start from the temporal prediction, if it is good enough. A good
+        # prediction only needs a refinement like the finest pyramid level;
+        # a bad one is not improved by more iterations, but by the initial
+        # estimate.
+        prediction = self.predictTransformMatrix(tile_index)
+        predicted_result = (None, None)
+        if prediction is not None:
+            predicted_transform_matrix, previous_correlation_coefficient = prediction
+            refinement_criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                                   self.refinement_iterations, self.refinement_eps)
+            try:
+                predicted_result = cv2.findTransformECC(reference_tile_C1,
+                                                        image_tile_C1,
+                                                        predicted_transform_matrix,
+                                                        self.motion_type,
+                                                        refinement_criteria)[::-1]
+            except:
+                pass
+            if self.isPredictionGood(predicted_result[1], previous_correlation_coefficient):
+                return predicted_result
+            self.instrumentation.recordEvent("warm_start_fallback", tile=tile_index)
+        
+        # rough inital alignment
+        if self.usePhaseCorrelation():
+            warp_matrix = self.estimateTransformPhaseCorrelation(self.reference_spectra[tile_index],
+                                                                 image_tile_C1)
+        elif self.initial_estimate == "feature":
+            warp_matrix = cv2.estimateRigidTransform(reference_tile, image_tile, False)
+        else:
+            warp_matrix = np.eye(2,3, dtype=np.float32)
+        
+        # if the initial alignment has failed, create unity matrix
+        if warp_matrix is None:
+            print ("WARNING: Initial alignment of tile failed!")
+            warp_matrix = np.eye(2,3, dtype=np.float32)
+        
+        # convert warp matrix to float32 because findTransformECC needs this            
+        warp_matrix = warp_matrix.astype(np.float32)   
+        
+        # Run the ECC algorithm. The results are stored in warp_matrix.
+        try:
+            (cc, transform_matrix) = cv2.findTransformECC(reference_tile_C1,
+                                                          image_tile_C1, 
+                                                          warp_matrix, 
+                                                          self.motion_type, 
+                                                          criteria)
+        except:
+            return predicted_result
+            
+        # keep the prediction if it was better after all
+        if predicted_result[1] is not None and predicted_result[1] > cc:
+            return predicted_result
+        return transform_matrix, cc
+        
+    ## Check whether the correlation coefficient of the alignment from the
+    #  temporal prediction is good enough to skip the initial estimate
+    #  @param correlation_coefficient correlation coefficient of the
+    #  alignment from the prediction or None if it has failed
+    #  @param previous_correlation_coefficient correlation coefficient of the
+    #  tile in the previous image
+    #  @return True if the result can be used
+    def isPredictionGood(self, correlation_coefficient, previous_correlation_coefficient):
+        return (correlation_coefficient is not None
+                and correlation_coefficient >= previous_correlation_coefficient - self.warm_start_tolerance)
+
+        
+    ## Calculate the transformation matrix of one tile coarse to fine.
+    #  The transformation is estimated on the coarsest level of the pyramid
+    #  and propagated and refined level by level. On the upscaled tile, only
+    #  a few ECC iterations are needed for the final refinement.
+    #  @param reference_pyramid pyramid of the greyscale reference tile as
+    #  calculated by buildPyramid
+    #  @param image_tile tile of the upscaled image as 8 bit BGR
+    #  @param tile_index index of the tile in self.tiles
+    #  @return tuple (transform matrix as float32 numpy array, correlation
+    #  coefficient). Both are None if the alignment has failed. If only the
+    #  refinement has failed, the correlation coefficient is the one of the
+    #  finest successful level.
+    def alignTilePyramid(self, reference_pyramid, image_tile, tile_index):
+        image_tile_C1 = CommonFunctions.convertToGray(image_tile)
+        
+        # with a good temporal prediction, the coarse levels are not needed
+        prediction = self.predictTransformMatrix(tile_index)
+        predicted_result = (None, None)
+        if prediction is not None:
+            predicted_transform_matrix, previous_correlation_coefficient = prediction
+            criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                        self.refinement_iterations, self.refinement_eps)
+            try:
+                predicted_result = cv2.findTransformECC(reference_pyramid[0],
+                                                        image_tile_C1,
+                                                        predicted_transform_matrix,
+                                                        self.motion_type,
+                                                        criteria)[::-1]
+            except:
+                pass
+            if self.isPredictionGood(predicted_result[1], previous_correlation_coefficient):
+                return predicted_result
+            self.instrumentation.recordEvent("warm_start_fallback", tile=tile_index)
+        
+        image_pyramid = self.buildPyramid(image_tile_C1)
+        
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                    self.pyramid_iterations, self.termination_eps)
+        
+        warp_matrix = None
+        if self.usePhaseCorrelation():
+            warp_matrix = self.estimateTransformPhaseCorrelation(self.reference_spectra[tile_index],
+                                                                 image_pyramid[-1])
+        if warp_matrix is None:
+            warp_matrix = np.eye(2,3, dtype=np.float32)
+        bool_success = False
+        cc = None
+        for level in range(len(reference_pyramid) - 1, 0, -1):
+            try:
+                (cc, warp_matrix) = cv2.findTransformECC(reference_pyramid[level],
+                                                         image_pyramid[level],
+                                                         warp_matrix,
+                                                         self.motion_type,
+                                                         criteria)
+                bool_success = True
+            except:
+                pass
+            
+            # pyrDown keeps every second pixel, so only the translation changes
+            warp_matrix = CommonFunctions.convertTransformMatrix(warp_matrix, 2.)
+            
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                    self.refinement_iterations, self.refinement_eps)
+        try:
+            (cc, transform_matrix) = cv2.findTransformECC(reference_pyramid[0],
+                                                          image_pyramid[0],
+                                                          warp_matrix,
+                                                          self.motion_type,
+                                                          criteria)
+        except:
+            # keep the estimate from the coarser levels if there is one
+            if not bool_success:
+                return predicted_result
+            transform_matrix = warp_matrix
+            
+        # keep the prediction if it was better after all
+        if predicted_result[1] is not None and (cc is None or predicted_result[1] > cc):
+            return predicted_result
+        return transform_matrix, cc
+        
+    ## Build a gaussian pyramid of an image
+    #  @param image greyscale image as numpy array
+    #  @return list of images, starting with the given one, each with half
+    #  the resolution of the previous one
+    def buildPyramid(self, image):
+        pyramid = [image]
+        for level in range(self.pyramid_levels):
+            # ECC needs some pixels to work with
+            if min(pyramid[-1].shape[:2]) < 128:
+                break
+            pyramid.append(cv2.pyrDown(pyramid[-1]))
+        return pyramid
+        
+    ## Check whether the initial estimate is done by phase correlation.
+    #  This is also the case if feature based estimation is selected, but
+    #  not available in the installed OpenCV version.
+    def usePhaseCorrelation(self):
+        if self.initial_estimate == "phase_correlation":
+            return True
+        return (self.initial_estimate == "feature"
+                and not hasattr(cv2, "estimateRigidTransform"))
+        
+    ## Calculate the spectra of a reference tile that are needed for phase
+    #  correlation
+    #  @param reference_tile_C1 greyscale reference tile as numpy array
+    #  @return dictionary of {spectrum, log_polar_spectrum}
+    def calculateReferenceSpectra(self, reference_tile_C1):
+        reference_spectra = {"spectrum" : self.calculateSpectrum(reference_tile_C1),
+                             "log_polar_spectrum" : None}
+        if self.estimate_rotation:
+            reference_spectra["log_polar_spectrum"] = self.calculateLogPolarSpectrum(reference_tile_C1)
+        return reference_spectra
+        
+    ## Calculate the fourier transform of an image, windowed to suppress the
+    #  influence of the image borders
+    #  @param image_C1 greyscale image as numpy array
+    #  @return complex spectrum as two channel float32 numpy array
+    def calculateSpectrum(self, image_C1):
+        window = cv2.createHanningWindow((image_C1.shape[1], image_C1.shape[0]),
+                                         cv2.CV_32F)
+        return cv2.dft(image_C1.astype(np.float32) * window,
+                       flags=cv2.DFT_COMPLEX_OUTPUT)
+        
+    ## Calculate the fourier transform of the log-polar representation of the
+    #  magnitude spectrum of an image. A rotation of the image is a shift
+    #  along the first axis of the log-polar representation.
+    #  @param image_C1 greyscale image as numpy array
+    #  @return complex spectrum as two channel float32 numpy array
+    def calculateLogPolarSpectrum(self, image_C1):
+        spectrum = self.calculateSpectrum(image_C1)
+        magnitude = cv2.magnitude(spectrum[:, :, 0], spectrum[:, :, 1])
+        magnitude = np.log1p(np.fft.fftshift(magnitude))
+        
+        height, width = magnitude.shape
+        max_radius = min(height, width) / 2.
+        log_polar = cv2.warpPolar(magnitude,
+                                  (int(max_radius), 720),
+                                  (width / 2., height / 2.),
+                                  max_radius,
+                                  cv2.WARP_POLAR_LOG + cv2.INTER_LINEAR)
+        
+        # the angle axis is periodic, so no window is applied
+        return cv2.dft(log_polar, flags=cv2.DFT_COMPLEX_OUTPUT)
+        
+    ## Find the shift between two images from their spectra
+    #  @param reference_spectrum spectrum of the reference as calculated by
+    #  calculateSpectrum
+    #  @param image_spectrum spectrum of the image
+    #  @return tuple ((shift_x, shift_y), response). The shift is the
+    #  translation of the image relative to the reference, the response is
+    #  the height of the correlation peak between 0 and 1.
+    def correlatePhase(self, reference_spectrum, image_spectrum):
+        cross_power_spectrum = cv2.mulSpectrums(image_spectrum,
+                                                reference_spectrum,
+                                                0,
+                                                conjB=True)
+        magnitude = cv2.magnitude(cross_power_spectrum[:, :, 0],
+                                  cross_power_spectrum[:, :, 1])
+        cross_power_spectrum /= (magnitude + 1e-12)[:, :, np.newaxis]
+        correlation = cv2.idft(cross_power_spectrum,
+                               flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)
+        
+        min_value, response, min_location, peak = cv2.minMaxLoc(correlation)
+        
+        # refine the peak position by the centroid of its neighbourhood,
+        # which wraps around the borders like the correlation does
+        height, width = correlation.shape
+        offsets = np.arange(-1, 2)
+        neighbourhood = correlation[np.ix_((peak[1] + offsets) % height,
+                                           (peak[0] + offsets) % width)]
+        neighbourhood = np.maximum(neighbourhood, 0.)
+        neighbourhood_sum = np.sum(neighbourhood)
+        shift_x = peak[0] + np.dot(np.sum(neighbourhood, axis=0), offsets) / neighbourhood_sum
+        shift_y = peak[1] + np.dot(np.sum(neighbourhood, axis=1), offsets) / neighbourhood_sum
+        
+        # shifts beyond half the size are negative shifts
+        if shift_x > width / 2.:
+            shift_x -= width
+        if shift_y > height / 2.:
+            shift_y -= height
+            
+        return (shift_x, shift_y), response
+        
+    ## Estimate the transformation of a tile by phase correlation
+    #  @param reference_spectra spectra of the reference tile as calculated
+    #  by calculateReferenceSpectra
+    #  @param image_tile_C1 greyscale tile of the image
+    #  @return transform matrix as float32 numpy array or None if the
+    #  correlation is too weak
+    def estimateTransformPhaseCorrelation(self, reference_spectra, image_tile_C1):
+        warp_matrix = np.eye(2,3, dtype=np.float32)
+        
+        if reference_spectra["log_polar_spectrum"] is not None:
+            image_log_polar_spectrum = self.calculateLogPolarSpectrum(image_tile_C1)
+            (shift_radius, shift_angle), response = self.correlatePhase(reference_spectra["log_polar_spectrum"],
+                                                                        image_log_polar_spectrum)
+            
+            # the magnitude spectrum is symmetric, so the angle is only
+            # known modulo 180 degrees
+            angle = shift_angle * 360. / image_log_polar_spectrum.shape[0]
+            angle = (angle + 90.) % 180. - 90.
+            
+            if response >= self.phase_correlation_min_response:
+                height, width = image_tile_C1.shape
+                center = ((width - 1) / 2., (height - 1) / 2.)
+                warp_matrix = cv2.getRotationMatrix2D(center, -angle, 1.).astype(np.float32)
                 
-                # Run the ECC algorithm. The results are stored in warp_matrix.
-                try:
-                    (cc, transform_matrix) = cv2.findTransformECC(reference_tile_C1,
-                                                                  image_tile_C1, 
-                                                                  warp_matrix, 
-                                                                  self.motion_type, 
-                                                                  criteria)
-                except:
-                    transform_matrix = previous_transform_matrix
-            
-                # fill the warp matrix into the dataset
-                dataset.appendTransformMatrix(index, transform_matrix)
+                # remove the rotation so that only the translation is left
+                image_tile_C1 = cv2.warpAffine(image_tile_C1,
+                                               warp_matrix,
+                                               (width, height),
+                                               flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
                 
-                # if next tile fails, use this one instead
-                previous_transform_matrix = transform_matrix
+        image_spectrum = self.calculateSpectrum(image_tile_C1)
+        shift, response = self.correlatePhase(reference_spectra["spectrum"],
+                                              image_spectrum)
+        if response < self.phase_correlation_min_response:
+            return None
             
-        return dataset
\ No newline at end of file
+        # combine rotation and translation
+        warp_matrix[:, 2] += np.dot(warp_matrix[:, :2], shift)
+        return warp_matrix
\ No newline at end of file
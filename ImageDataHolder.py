@@ -21,28 +21,68 @@ import cv2
 
 class ImageDataHolder:
     ## The Constructor
-    #  @param hdu_lists List of astropy hdulist objects containing images from fits.
-    def __init__(self, image_paths):
+    #  @param image_paths list of paths of the images
+    #  @param frame_cache FrameCache object shared by all users of the
+    #  dataset, or None to decode the images on every access
+    #  @param instrumentation Instrumentation object the decoding times are
+    #  recorded with, or None
+    #  @param frame_store FrameStore object holding the decoded images in the
+    #  same order, or None. It takes precedence over the frame cache.
+    def __init__(self, image_paths, frame_cache=None, instrumentation=None,
+                 frame_store=None):
         self.image_paths = image_paths
+        self.frame_cache = frame_cache
+        self.instrumentation = instrumentation
+        self.frame_store = frame_store
         self.transform_matrices = []
+        self.correlation_coefficients = []
         self.distortion_maps = []
         
         # Fill the other lists with None so that they have the right length
         num_images = len(image_paths)
         for index in range(num_images):
             self.transform_matrices.append([])
-            self.distortion_maps.append([])
+            self.correlation_coefficients.append([])
+            self.distortion_maps.append(None)
 
     ## Get data at given index
     #  @param index integer index of the data to get
     #  @return dictionary of {hdu_list, transform_matrix, distortion_map}
     def getData(self, index):
-        return {"image" : cv2.imread(self.image_paths[index]),
+        return {"image" : self.getImage(index),
                 "transform_matrix" : self.transform_matrices[index],
                 "distortion_map" : self.distortion_maps[index]}
     
+    ## Get the decoded image at given index
+    #  @param index integer index of the image
+    #  @return image as numpy array. If a frame cache or a frame store is
+    #  used, it is read-only.
+    def getImage(self, index):
+        if self.frame_store is not None:
+            return self.frame_store.getFrame(index)
+        image_path = self.image_paths[index]
+        if self.frame_cache is None:
+            return self.decodeImage(image_path)
+        return self.frame_cache.getFrame(image_path,
+                                         lambda: self.decodeImage(image_path))
+        
+    ## Get the image at given index for the alignment. This is the greyscale
+    #  plane of the frame store if it has one, else the decoded image.
+    #  @param index integer index of the image
+    #  @return image as numpy array
+    def getAlignmentImage(self, index):
+        if self.frame_store is not None:
+            return self.frame_store.getAlignmentFrame(index)
+        return self.getImage(index)
+        
+    def decodeImage(self, image_path):
+        if self.instrumentation is None:
+            return cv2.imread(image_path)
+        with self.instrumentation.measure("decode", path=image_path):
+            return cv2.imread(image_path)
+    
     def getImageSize(self, index):
-        return cv2.imread(self.image_paths[index].shape)
+        return self.getImage(index).shape
                           
     def getImageCount(self):
         return len(self.image_paths)
@@ -50,6 +90,13 @@ class ImageDataHolder:
     def appendTransformMatrix(self, index, transform_matrix):
         self.transform_matrices[index].append(transform_matrix)
         
+    ## Append the correlation coefficient of the ECC alignment of a tile
+    #  @param index index of the image
+    #  @param correlation_coefficient correlation coefficient or None if the
+    #  alignment of the tile has failed
+    def appendCorrelationCoefficient(self, index, correlation_coefficient):
+        self.correlation_coefficients[index].append(correlation_coefficient)
+        
     def setDistortionMap(self, index, distortion_map):
         self.distortion_maps[index] = distortion_map
         
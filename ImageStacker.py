@@ -17,21 +17,40 @@
     along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import json
 import numpy as np
+import os
+import tempfile
+import time
 import ImageAligner
 import cv2
 import ImageDataHolder
+import FrameCache
+import FrameStore
 import CommonFunctions
+import AlignmentCache
+import Checkpoint
 import Deconvolver
-from PyQt5.QtCore import QThread, pyqtSignal
+import FlowCalculator
+import FramePrefetcher
+import FrameSelector
+import ImageWriter
+import Instrumentation
+import RobustStacker
+import WarpMap
 
 
-class ImageStacker(QThread):
-    signal_finished = pyqtSignal()
-    signal_status_update = pyqtSignal(str)
+## Stacks a series of images into one upscaled image. This is the pure python
+#  engine without any Qt dependency. For use in the GUI, it is wrapped by
+#  ImageStackerThread.
+class ImageStacker:
     
-    def __init__(self, image_paths, output_path):       
-        QThread.__init__(self)
+    ## The constructor
+    #  @param image_paths list of paths of the images to stack
+    #  @param output_path path of the output image including file extension
+    #  @param status_callback callable that is called with a status string
+    #  whenever the progress changes. May be None.
+    def __init__(self, image_paths, output_path, status_callback=None):
         self.image_paths = image_paths
         self.output_path = output_path
         self.scale_factor = 2.
@@ -41,107 +60,791 @@ class ImageStacker(QThread):
         self.tiles = None
         self.bool_deconvolve = True
         
+        # memory budget in bytes for decoded frames shared by alignment and
+        # stacking. 0 disables the cache.
+        self.frame_cache_size = 0
+        self.frame_cache_compression = False
+        self.frame_cache = None
         
-    def __del__(self):
-        self.wait()
+        # if True, all frames are decoded once into a single memory mapped
+        # FrameStore in scratch_directory before the alignment, which all
+        # processing stages and the alignment worker processes read from
+        # without decoding or copying them again. If frame_store_gray is
+        # True, a greyscale plane is stored as well and used for the
+        # alignment. The frames are decoded by frame_store_workers threads,
+        # 0 uses all cores.
+        self.use_frame_store = False
+        self.frame_store_gray = False
+        self.frame_store_workers = 0
+        self.frame_store = None
         
-    def run(self):
-        self.stackImages()
+        # if True, each image is decoded and upscaled only once and aligned
+        # and stacked in a single pass. Ignored by the robust stacking modes
+        # and the seeing correction, see isStreaming.
+        self.streaming = False
+        
+        # if True, the stacked image is kept in a memory mapped file in
+        # scratch_directory instead of RAM, and images are upscaled and
+        # stacked tile by tile, so that memory does not depend on the size
+        # of the upscaled image. None uses the default temporary directory.
+        self.out_of_core = False
+        self.scratch_directory = None
+        self.scratch_files = []
+        
+        # "mean" averages all images, "sigma_clip" and "median" reject
+        # outliers like satellites or birds. The robust modes always align
+        # all images first and ignore streaming. Their intermediate arrays
+        # have the size of the upscaled image, and are only kept out of
+        # memory with out_of_core.
+        self.stacking_mode = "mean"
+        self.robust_stacker = RobustStacker.RobustStacker()
+        
+        # "tiles" upscales the whole image and warps the upscaled tiles.
+        # "direct" interpolates the aligned tiles directly from the raw image,
+        # which needs only one interpolation and no upscaled copy. "remap"
+        # interpolates the transforms of the tiles into a smooth dense map and
+        # warps the raw image with cv2.remap in bands of remap_band_height
+        # rows, without margins and without seams between the tiles.
+        self.warp_engine = "tiles"
+        self.remap_band_height = 128
+        
+        # if True, the distortion of each image by seeing or heat shimmer is
+        # measured by the FlowCalculator and corrected while warping with the
+        # dense warp map, regardless of warp_engine. The mean distortion of
+        # all images is needed, so the images are always aligned in a first
+        # pass and streaming is ignored.
+        self.correct_seeing = False
+        self.flow_calculator = FlowCalculator.FlowCalculator()
+        
+        # directory for diagnostic images like optical flows, alignment
+        # residuals and tile maps. None turns diagnostics off entirely.
+        self.diagnostics_directory = None
+        
+        # the output image and the diagnostic images are written in the
+        # background by an ImageWriter with this queue size
+        self.image_writer_queue_size = 4
+        self.image_writer = None
+        
+        # scores the frames before the alignment and keeps only the best
+        # ones if configured so
+        self.frame_selector = FrameSelector.FrameSelector()
+        
+        # report of the last run as dictionary with the quality scores and
+        # correlation coefficients of the frames. It is written as JSON to
+        # report_path if that is not None.
+        self.report = None
+        self.report_path = None
+        
+        # directory of the alignment cache, which stores the transform
+        # matrices of the bursts on disk, so that re-running a burst with
+        # different stacking or deconvolution settings skips the alignment.
+        # None disables the cache. Its size is limited to
+        # alignment_cache_size bytes. If clear_alignment_cache is True, all
+        # entries are deleted before the run.
+        self.alignment_cache_directory = None
+        self.alignment_cache_size = 100 * 1024 * 1024
+        self.clear_alignment_cache = False
+        self.alignment_cache = None
+        self.alignment_cache_key = None
+        
+        # directory for checkpoints of long runs. The transform matrices and
+        # the sum of the images stacked so far are saved every
+        # checkpoint_interval images, when the run is aborted and once the
+        # stacking has finished. If resume is True, a run with the same
+        # images and settings continues at the first unprocessed image. The
+        # checkpoint is deleted after the output image has been written. None
+        # disables checkpoints. The sum is only checkpointed in mean mode.
+        self.checkpoint_directory = None
+        self.checkpoint_interval = 10
+        self.resume = False
+        self.checkpoint = None
+        self.checkpoint_key = None
+        self.images_since_checkpoint = 0
+        
+        # sum of the images stacked so far in mean mode and their count. The
+        # stacked images are the first ones of the dataset.
+        self.stacked_image_upscaled = None
+        self.num_stacked_images = 0
+        self.image_aligner = ImageAligner.ImageAligner(self.scale_factor)
+        self.deconvolver = Deconvolver.Deconvolver()
+        self.status_callback = status_callback
+        
+        # records structured events like decoding, upscaling, alignment,
+        # warping and deconvolution times. Sinks like a JsonLinesSink or an
+        # EventCollector can be added to it. It is shared with the aligner
+        # and the deconvolver.
+        self.instrumentation = Instrumentation.Instrumentation()
+        self.image_aligner.instrumentation = self.instrumentation
+        self.deconvolver.instrumentation = self.instrumentation
         
     def abort(self):
         self.continue_processing[0] = False
+        
+    ## pass a status string to the status callback, if there is one
+    #  @param status status string
+    def emitStatus(self, status):
+        if self.status_callback is not None:
+            self.status_callback(status)
     
     ## stack a set of Images by averaging
-    #  @param images list of astropy fits Objects 
+    #  @return stacked image as numpy array or "aborted"
     def stackImages(self):
+        # the writer thread, the frame store and the scratch files are also
+        # released if the run fails, e.g. because an image cannot be read
+        try:
+            return self.runStacking()
+        finally:
+            self.finishProcessing()
+            
+    ## Run the stages of stackImages, which releases the scratch files
+    #  afterwards. On success, they are already released here, as the output
+    #  image has to be written before the checkpoint is deleted.
+    #  @return stacked image as numpy array or "aborted"
+    def runStacking(self):
+        run_start_time = time.perf_counter()
         
         # build the image data object containing the hdulists
-        dataset = ImageDataHolder.ImageDataHolder(self.image_paths)     
+        if self.frame_cache_size > 0:
+            self.frame_cache = FrameCache.FrameCache(self.frame_cache_size,
+                                                     self.frame_cache_compression)
+        else:
+            self.frame_cache = None
+        dataset = ImageDataHolder.ImageDataHolder(self.image_paths,
+                                                  self.frame_cache,
+                                                  self.instrumentation)
         
-        # instanciate the image aligner object
-        image_aligner = ImageAligner.ImageAligner(self.scale_factor)
+        # the scale factor may have been changed after construction
+        self.image_aligner.scale_factor = self.scale_factor
         
-        # calculate the transformation matrices for alignment
-        image_dimension = cv2.imread(self.image_paths[0]).shape
+        self.image_writer = ImageWriter.ImageWriter(self.image_writer_queue_size)
+        if self.diagnostics_directory is not None:
+            os.makedirs(self.diagnostics_directory, exist_ok=True)
+        self.flow_calculator.optical_flow_output_directory = self.diagnostics_directory
+        self.flow_calculator.image_writer = self.image_writer
+        
+        self.report = {"frames" : [{"path" : image_path,
+                                    "quality_score" : None,
+                                    "stacked" : True,
+                                    "correlation_coefficients" : None,
+                                    "mean_correlation_coefficient" : None}
+                                   for image_path in self.image_paths]}
+        if self.frame_selector.isActive():
+            dataset = self.selectFrames(dataset)
+            if dataset == "aborted":
+                return "aborted"
+                
+        # only the selected frames are ingested
+        if self.use_frame_store:
+            if self.ingestFrames(dataset) == "aborted":
+                return "aborted"
+        
+        image_dimension = dataset.getImageSize(0)
         self.tiles = self.calculateTiles(image_dimension)
-        image_aligner.calculateTransformationMatrices(dataset, 
-                                                      self.tiles,
-                                                      self.continue_processing,
-                                                      self.signal_status_update)
         
-        # create output image as numpy array with upscaled image size
-        stacked_image = np.zeros(image_dimension, np.float32)
-        stacked_image_upscaled = cv2.resize(stacked_image,
-                                            None,
-                                            fx=self.scale_factor,
-                                            fy=self.scale_factor,
-                                            interpolation=cv2.INTER_CUBIC)
-            
-# will be used for motion detection in the far future...
-#        # calculate distortion maps
-#        if self.config["Processing_Options"]["correct_seeing"] == "True":
-#            # instanciate the flow calculator object
-#            flow_calculator = FlowCalculator.FlowCalculator(self.config, self.scale_factor)
-#            
-#            # calculate the distortion maps
-#            flow_calculator.calculateDistortionMaps(dataset)
+        self.alignment_cache = None
+        if self.alignment_cache_directory is not None:
+            self.alignment_cache = AlignmentCache.AlignmentCache(self.alignment_cache_directory,
+                                                                 self.alignment_cache_size)
+            if self.clear_alignment_cache:
+                self.alignment_cache.clear()
+            self.alignment_cache_key = self.alignment_cache.calculateKey(dataset.image_paths,
+                                                                         self.getAlignmentParameters())
+        
+        self.stacked_image_upscaled = None
+        self.num_stacked_images = 0
+        self.images_since_checkpoint = 0
+        self.checkpoint = None
+        if self.checkpoint_directory is not None:
+            self.checkpoint = Checkpoint.Checkpoint(self.checkpoint_directory)
+            self.checkpoint_key = self.checkpoint.calculateKey(dataset.image_paths,
+                                                               self.getCheckpointParameters())
+            if self.resume:
+                self.resumeFromCheckpoint(dataset, image_dimension)
+        
+        if self.streaming and not self.isStreaming():
+            print ("streaming is not available with robust stacking or seeing correction, "
+                   "aligning all images first")
+        if self.stacking_mode != "mean":
+            stacked_image_upscaled = self.alignAndStackImagesRobust(dataset,
+                                                                    image_dimension)
+        elif (self.isStreaming()
+              and not (self.alignment_cache is not None
+                       and self.alignment_cache.contains(self.alignment_cache_key))):
+            # if the alignment is cached, there is nothing to stream
+            stacked_image_upscaled = self.alignAndStackImagesStreaming(dataset,
+                                                                      image_dimension)
+            if self.alignment_cache is not None and not isinstance(stacked_image_upscaled, str):
+                self.alignment_cache.store(self.alignment_cache_key, dataset)
+        else:
+            stacked_image_upscaled = self.alignAndStackImages(dataset,
+                                                              image_dimension)
+        if isinstance(stacked_image_upscaled, str) and stacked_image_upscaled == "aborted":
+            if self.checkpoint is not None:
+                self.saveCheckpoint(dataset)
+            return "aborted"
+        
+        if self.diagnostics_directory is not None:
+            if self.writeAlignmentDiagnostics(dataset) == "aborted":
+                return "aborted"
 
-        # average images
-        num_images = len(self.image_paths) # number of images = length of image list
+        if self.stacking_mode == "mean":
+            stacked_image_upscaled /= dataset.getImageCount()
+        
+        if self.frame_cache is not None:
+            statistics = self.frame_cache.getStatistics()
+            print ("frame cache: ", statistics["hits"], " hits, ",
+                   statistics["misses"], " misses, ",
+                   statistics["evictions"], " evictions")
+
+        print ("deconvolve image")
+        if self.bool_deconvolve:
+            # in out-of-core mode, the tiled deconvolution writes into
+            # another memory mapped file
+            deconvolution_output = None
+            if self.out_of_core and self.deconvolver.tile_size > 0:
+                deconvolution_output = self.createScratchArray(stacked_image_upscaled.shape)
+            with self.instrumentation.measure("deconvolution") as fields:
+                stacked_image_upscaled_deconvolved = self.deconvolver.deconvolveLucy(stacked_image_upscaled,
+                                                                                     self.continue_processing,
+                                                                                     self.emitStatus,
+                                                                                     deconvolution_output)
+                fields["iterations"] = self.deconvolver.iterations_used
+            print ("deconvolution used ", self.deconvolver.iterations_used, " iterations")
+        else:
+            stacked_image_upscaled_deconvolved = stacked_image_upscaled
+
+        if not self.continue_processing[0]:
+            return "aborted"
+
+        self.image_writer.write(self.output_path, stacked_image_upscaled_deconvolved)
+        
+        self.updateReport(dataset)
+        if self.report_path is not None:
+            with open(self.report_path, "w") as report_file:
+                json.dump(self.report, report_file, indent=2)
+        
+        # the output image has to be written before the scratch files are
+        # closed, as it may be memory mapped
+        self.finishProcessing()
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+        self.instrumentation.recordEvent("run",
+                                         num_images=dataset.getImageCount(),
+                                         seconds=time.perf_counter() - run_start_time)
+        self.emitStatus("finished!")
+    
+        return stacked_image_upscaled_deconvolved
+        
+    ## Score the frames and keep only the best ones
+    #  @param dataset ImageDataHolder object with all frames
+    #  @return ImageDataHolder object with the selected frames or "aborted"
+    def selectFrames(self, dataset):
+        print ("scoring frames")
+        scores = self.frame_selector.scoreFrames(dataset,
+                                                 self.continue_processing,
+                                                 self.emitStatus)
+        if scores == "aborted":
+            return "aborted"
+            
+        selected_indices = self.frame_selector.selectFrames(scores)
+        print ("selected ", len(selected_indices), " of ", len(scores), " frames")
+        for index, frame_report in enumerate(self.report["frames"]):
+            frame_report["quality_score"] = scores[index]
+            frame_report["stacked"] = index in selected_indices
+            
+        return ImageDataHolder.ImageDataHolder([self.image_paths[index] for index in selected_indices],
+                                               self.frame_cache,
+                                               self.instrumentation)
+        
+    ## Decode the frames of a dataset into a new FrameStore, which the dataset
+    #  reads its images from afterwards. Frames that are in the frame cache,
+    #  e.g. from the frame selection, are not decoded again. The frame cache
+    #  is not needed any more afterwards and is cleared.
+    #  @param dataset ImageDataHolder object
+    #  @return "aborted" if aborted, else None
+    def ingestFrames(self, dataset):
+        print ("decoding frames into the frame store")
+        self.frame_store = FrameStore.FrameStore(dataset.image_paths,
+                                                 self.scratch_directory,
+                                                 self.frame_store_gray)
+        self.frame_store.num_workers = self.frame_store_workers
+        with self.instrumentation.measure("ingest", num_images=dataset.getImageCount()):
+            if self.frame_store.ingest(dataset.getImage,
+                                       self.continue_processing,
+                                       self.emitStatus) == "aborted":
+                return "aborted"
+        dataset.frame_store = self.frame_store
+        if self.frame_cache is not None:
+            self.frame_cache.clear()
+        
+    ## Add the results of the processing to the report
+    #  @param dataset ImageDataHolder object of the stacked frames
+    def updateReport(self, dataset):
+        stacked_frame_reports = [frame_report for frame_report in self.report["frames"]
+                                 if frame_report["stacked"]]
+        for index, frame_report in enumerate(stacked_frame_reports):
+            correlation_coefficients = [None if correlation_coefficient is None else float(correlation_coefficient)
+                                        for correlation_coefficient in dataset.correlation_coefficients[index]]
+            valid_correlation_coefficients = [correlation_coefficient for correlation_coefficient in correlation_coefficients
+                                              if correlation_coefficient is not None]
+            frame_report["correlation_coefficients"] = correlation_coefficients
+            frame_report["mean_correlation_coefficient"] = (float(np.mean(valid_correlation_coefficients))
+                                                            if valid_correlation_coefficients else None)
+            
+        self.report["num_frames"] = len(self.image_paths)
+        self.report["num_frames_stacked"] = dataset.getImageCount()
+        self.report["deconvolution_iterations"] = (self.deconvolver.iterations_used
+                                                   if self.bool_deconvolve else 0)
+        
+    ## Wait until all images are written and delete the scratch files
+    def finishProcessing(self):
+        if self.image_writer is not None:
+            image_writer = self.image_writer
+            self.image_writer = None
+            self.flow_calculator.image_writer = None
+            try:
+                image_writer.close()
+            finally:
+                self.closeScratchFiles()
+        else:
+            self.closeScratchFiles()
+            
+    ## Write diagnostic images of the alignment into the diagnostics
+    #  directory: for every image the absolute difference of the aligned
+    #  image to the reference image and a map of the tiles with their
+    #  displacements, both at raw resolution.
+    #  @param dataset ImageDataHolder object with filled transform matrices
+    #  @return "aborted" if aborted, else None
+    def writeAlignmentDiagnostics(self, dataset):
+        num_images = dataset.getImageCount()
+        image_reference = None
         for index in range(num_images):
+            if self.continue_processing[0] == False:
+                return "aborted"
+            self.emitStatus("writing diagnostics of image " + str(index + 1)
+                            + " of " + str(num_images))
+            
+            data = dataset.getData(index)
+            transform_matrices = data["transform_matrix"]
+            image_aligned = self.warpImageRawResolution(data["image"],
+                                                        transform_matrices)
+            if index == 0:
+                image_reference = image_aligned
+                
+            # amplify the residuals, as they are small for good alignment
+            residual = cv2.absdiff(image_aligned, image_reference)
+            self.image_writer.write(os.path.join(self.diagnostics_directory,
+                                                 "residual_" + str(index) + ".png"),
+                                    residual,
+                                    lambda residual: CommonFunctions.convertToUint8(residual * 4.))
+            self.image_writer.write(os.path.join(self.diagnostics_directory,
+                                                 "tiles_" + str(index) + ".png"),
+                                    image_reference,
+                                    lambda image, transform_matrices=transform_matrices: self.drawTileMap(image, transform_matrices))
+            
+    ## Draw the tiles without margins into an image at raw resolution, with
+    #  arrows showing the displacement of each tile amplified ten times
+    #  @param image grayscale image at raw resolution as numpy float32 array
+    #  @param transform_matrices list of transform matrices, one for each tile
+    #  @return tile map as BGR numpy uint8 array
+    def drawTileMap(self, image, transform_matrices):
+        tile_map = cv2.cvtColor(CommonFunctions.convertToUint8(image), cv2.COLOR_GRAY2BGR)
+        for tile, transform_matrix in zip(self.tiles, transform_matrices):
+            min_x = tile["x"][0] + tile["margin_x"][0]
+            min_y = tile["y"][0] + tile["margin_y"][0]
+            max_x = tile["x"][1] - tile["margin_x"][1]
+            max_y = tile["y"][1] - tile["margin_y"][1]
+            cv2.rectangle(tile_map,
+                          (int(min_x / self.scale_factor), int(min_y / self.scale_factor)),
+                          (int(max_x / self.scale_factor) - 1, int(max_y / self.scale_factor) - 1),
+                          (0, 255, 0))
+            
+            # displacement of the tile center in tile coordinates
+            center = np.array([(min_x + max_x) / 2. - tile["x"][0],
+                               (min_y + max_y) / 2. - tile["y"][0]])
+            displacement = np.dot(transform_matrix[:, :2], center) + transform_matrix[:, 2] - center
+            start = (center + [tile["x"][0], tile["y"][0]]) / self.scale_factor
+            end = start + 10. * displacement / self.scale_factor
+            cv2.arrowedLine(tile_map,
+                            (int(round(start[0])), int(round(start[1]))),
+                            (int(round(end[0])), int(round(end[1]))),
+                            (0, 0, 255))
+        return tile_map
+
+    ## Calculate the transformation matrices for all images and sum up the
+    #  aligned images. All images are read twice, once for alignment and once
+    #  for stacking.
+    #  @param dataset ImageDataHolder object
+    #  @param image_dimension shape of the raw images
+    #  @return sum of the aligned upscaled images as numpy float32 array or
+    #  "aborted"
+    def alignAndStackImages(self, dataset, image_dimension):
+        # calculate the transformation matrices for alignment
+        alignment_result = self.calculateTransformationMatrices(dataset)
+        if alignment_result == "aborted":
+            return "aborted"
+        
+        if self.correct_seeing:
+            if self.calculateDistortionMaps(dataset) == "aborted":
+                return "aborted"
+        
+        # create output image as numpy array with upscaled image size, or
+        # continue the sum of a checkpoint
+        stacked_image_upscaled = self.getPartialStack(image_dimension)
+
+        # average images
+        num_images = dataset.getImageCount()
+        for index in range(self.num_stacked_images, num_images):
             
             if self.continue_processing[0] == False:
                 return "aborted"
 
             print ("stacking image ", index)
             status = "stacking image " + str(index + 1) + " of " + str(num_images)
-            self.signal_status_update.emit(status)
+            self.emitStatus(status)
 
             # get the data of given index
             data = dataset.getData(index)
 
-            # align and undistort image
-            image_processed = self.processImage(index, data)
+            # align the image and add it to the stack
+            self.accumulateImage(stacked_image_upscaled,
+                                 self.warpImageTiles(data["image"],
+                                                     data["transform_matrix"],
+                                                     distortion_map=data["distortion_map"]),
+                                 index)
             
             del data
+            self.num_stacked_images = index + 1
+            self.updateCheckpoint(dataset)
             
-            # stack the image
-            stacked_image_upscaled += image_processed
-
-        stacked_image_upscaled /= num_images
+        self.updateCheckpoint(dataset, force=True)
+        return stacked_image_upscaled
+        
+    ## Calculate the transformation matrices for all images or load them from
+    #  the alignment cache
+    #  @param dataset ImageDataHolder object
+    #  @return dataset with filled transform matrices or "aborted"
+    def calculateTransformationMatrices(self, dataset):
+        if self.alignment_cache is not None:
+            if self.alignment_cache.load(self.alignment_cache_key, dataset):
+                print ("loaded alignment from the cache")
+                self.emitStatus("loaded alignment from the cache")
+                return dataset
+                
+        with self.instrumentation.measure("alignment"):
+            alignment_result = self.image_aligner.calculateTransformationMatrices(dataset, 
+                                                                                  self.tiles,
+                                                                                  self.continue_processing,
+                                                                                  self.emitStatus,
+                                                                                  lambda index: self.updateCheckpoint(dataset))
+        if alignment_result != "aborted" and self.alignment_cache is not None:
+            self.alignment_cache.store(self.alignment_cache_key, dataset)
+        return alignment_result
+        
+    ## Check whether the images are aligned and stacked in a single pass.
+    #  The robust stacking modes and the seeing correction need all images
+    #  aligned first, so they always use two passes.
+    #  @return True if streaming is used
+    def isStreaming(self):
+        return self.streaming and self.stacking_mode == "mean" and not self.correct_seeing
+        
+    ## Get all parameters the transform matrices depend on
+    #  @return dictionary of parameter names and values
+    def getAlignmentParameters(self):
+        parameters = self.image_aligner.getParameters()
+        parameters["tile_size"] = self.tile_size
+        parameters["tile_margin"] = self.tile_margin
+        
+        # the streaming alignment runs in this process, so the temporal
+        # prediction is used regardless of the number of workers
+        if self.isStreaming():
+            parameters["temporal_prediction"] = self.image_aligner.temporal_prediction
+        
+        # the greyscale plane is converted before upscaling, which changes
+        # the rounding of the alignment images
+        parameters["frame_store_gray"] = self.use_frame_store and self.frame_store_gray
+        return parameters
+        
+    ## Get all parameters the transform matrices and the sum of the stacked
+    #  images depend on
+    #  @return dictionary of parameter names and values
+    def getCheckpointParameters(self):
+        parameters = self.getAlignmentParameters()
+        parameters["stacking_mode"] = self.stacking_mode
+        parameters["warp_engine"] = self.warp_engine
+        parameters["correct_seeing"] = self.correct_seeing
+        if self.correct_seeing:
+            flow_calculator = self.flow_calculator
+            parameters["flow"] = [flow_calculator.pyr_scale, flow_calculator.levels,
+                                  flow_calculator.winsize, flow_calculator.iterations,
+                                  flow_calculator.poly_n, flow_calculator.poly_sigma]
+        return parameters
+        
+    ## Load the transform matrices and the partial sum of a previous run from
+    #  the checkpoint, if it matches the current images and settings
+    #  @param dataset ImageDataHolder object with empty transform matrices
+    #  @param image_dimension shape of the raw images
+    def resumeFromCheckpoint(self, dataset, image_dimension):
+        checkpoint_result = self.checkpoint.load(self.checkpoint_key, dataset)
+        if checkpoint_result is None:
+            print ("no matching checkpoint found, starting from the beginning")
+            return
+        
+        num_stacked_images, stacked_image = checkpoint_result
+        if stacked_image is not None and self.stacking_mode == "mean":
+            self.getPartialStack(image_dimension)[...] = stacked_image
+            self.num_stacked_images = num_stacked_images
+        del stacked_image
+        
+        num_aligned_images = sum(1 for transform_matrices in dataset.transform_matrices
+                                 if transform_matrices)
+        status = ("resuming from checkpoint with "
+                  + str(num_aligned_images) + " images aligned and "
+                  + str(self.num_stacked_images) + " stacked of "
+                  + str(dataset.getImageCount()))
+        print (status)
+        self.emitStatus(status)
+        
+    ## Get the sum of the images stacked so far, creating it if needed
+    #  @param image_dimension shape of the raw images
+    #  @return sum as numpy float32 array
+    def getPartialStack(self, image_dimension):
+        if self.stacked_image_upscaled is None:
+            self.stacked_image_upscaled = self.createStackedImage(image_dimension)
+        return self.stacked_image_upscaled
+        
+    ## Count a processed image and save a checkpoint every
+    #  checkpoint_interval images
+    #  @param dataset ImageDataHolder object
+    #  @param force if True, save a checkpoint if any image has been processed
+    #  since the last one
+    def updateCheckpoint(self, dataset, force=False):
+        if self.checkpoint is None:
+            return
+        if not force:
+            self.images_since_checkpoint += 1
+        if (self.images_since_checkpoint >= self.checkpoint_interval
+            or (force and self.images_since_checkpoint > 0)):
+            self.saveCheckpoint(dataset)
+            
+    ## Save the transform matrices and the partial sum
+    #  @param dataset ImageDataHolder object
+    def saveCheckpoint(self, dataset):
+        print ("saving checkpoint")
+        self.checkpoint.save(self.checkpoint_key, dataset,
+                             self.stacked_image_upscaled, self.num_stacked_images)
+        self.images_since_checkpoint = 0
+        
+    ## Calculate the transformation matrices for all images and combine the
+    #  aligned images with outlier rejection by the RobustStacker.
+    #  @param dataset ImageDataHolder object
+    #  @param image_dimension shape of the raw images
+    #  @return combined aligned upscaled image as numpy float32 array or
+    #  "aborted"
+    def alignAndStackImagesRobust(self, dataset, image_dimension):
+        alignment_result = self.calculateTransformationMatrices(dataset)
+        if alignment_result == "aborted":
+            return "aborted"
+        
+        if self.correct_seeing:
+            if self.calculateDistortionMaps(dataset) == "aborted":
+                return "aborted"
+        
+        self.robust_stacker.mode = self.stacking_mode
+        return self.robust_stacker.stackImages(dataset.getImageCount(),
+                                               self.calculateUpscaledShape(image_dimension),
+                                               self.warpImageTilesOfIndex(dataset),
+                                               self.createArray,
+                                               self.createScratchArray,
+                                               self.continue_processing,
+                                               self.emitStatus)
+        
+    ## Align and sum up the images in a single pass. Each image is decoded and
+    #  upscaled once, aligned tile by tile and added to the sum right away,
+    #  while the next image is decoded and upscaled in the background.
+    #  @param dataset ImageDataHolder object
+    #  @param image_dimension shape of the raw images
+    #  @return sum of the aligned upscaled images as numpy float32 array or
+    #  "aborted"
+    def alignAndStackImagesStreaming(self, dataset, image_dimension):
+        stacked_image_upscaled = self.getPartialStack(image_dimension)
+        
+        def load_function(index):
+            image = dataset.getImage(index)
+            with self.instrumentation.measure("upscale", image=index):
+                image_upscaled = CommonFunctions.preprocessImage(image,
+                                                                 self.scale_factor,
+                                                                 interpolation=cv2.INTER_CUBIC)
+            return image, image_upscaled
+        num_images = dataset.getImageCount()
+        
+        # when resuming, the reference is not among the remaining images
+        first_index = self.num_stacked_images
+        if 0 < first_index < num_images:
+            reference_upscaled = load_function(0)[1]
+            self.image_aligner.setUpscaledReference(CommonFunctions.convertToUint8(reference_upscaled),
+                                                    self.tiles)
+            del reference_upscaled
+            
+        frame_prefetcher = FramePrefetcher.FramePrefetcher(load_function,
+                                                           range(first_index, num_images))
+        try:
+            for index, (image, image_upscaled) in frame_prefetcher:
+                
+                if self.continue_processing[0] == False:
+                    return "aborted"
+                    
+                print ("aligning and stacking image ", index)
+                status_prefix = ("aligning and stacking image "
+                                 + str(index + 1)
+                                 + " of "
+                                 + str(num_images))
+                self.emitStatus(status_prefix)
+                
+                image_upscaled_8u = CommonFunctions.convertToUint8(image_upscaled)
+                if index == 0:
+                    # the first image is the reference
+                    self.image_aligner.setUpscaledReference(image_upscaled_8u,
+                                                            self.tiles)
+                    transform_matrices = [np.eye(2, 3, dtype=np.float32) for tile in self.tiles]
+                    correlation_coefficients = [1. for tile in self.tiles]
+                elif dataset.transform_matrices[index]:
+                    # aligned before the checkpoint was saved
+                    transform_matrices = None
+                    self.image_aligner.updateHistory(dataset.transform_matrices[index],
+                                                     dataset.correlation_coefficients[index])
+                else:
+                    tile_status_callback = lambda status: self.emitStatus(status_prefix + ": " + status)
+                    with self.instrumentation.measure("align", image=index):
+                        alignment_result = self.image_aligner.alignUpscaledImage(image_upscaled_8u,
+                                                                                 self.continue_processing,
+                                                                                 tile_status_callback)
+                    if alignment_result == "aborted":
+                        return "aborted"
+                    transform_matrices, correlation_coefficients = alignment_result
+                del image_upscaled_8u
+                    
+                if transform_matrices is None:
+                    transform_matrices = dataset.transform_matrices[index]
+                else:
+                    for transform_matrix in transform_matrices:
+                        dataset.appendTransformMatrix(index, transform_matrix)
+                    for correlation_coefficient in correlation_coefficients:
+                        dataset.appendCorrelationCoefficient(index, correlation_coefficient)
+                
+                # add the aligned tiles to the stack without creating a full
+                # size aligned image
+                self.accumulateImage(stacked_image_upscaled,
+                                     self.warpImageTiles(image,
+                                                         transform_matrices,
+                                                         image_upscaled),
+                                     index)
+                self.num_stacked_images = index + 1
+                self.updateCheckpoint(dataset)
+        finally:
+            frame_prefetcher.stop()
+            
+        self.updateCheckpoint(dataset, force=True)
+        return stacked_image_upscaled
 
-        print ("deconvolve image")
-        if self.continue_processing[0]:
-            if self.bool_deconvolve:
-                deconvolver = Deconvolver.Deconvolver()
-                stacked_image_upscaled_deconvolved = deconvolver.deconvolveLucy(stacked_image_upscaled,
-                                                                                self.continue_processing,
-                                                                                self.signal_status_update)
-            else:
-                stacked_image_upscaled_deconvolved = stacked_image_upscaled
-        #stacked_image_upscaled_deconvolved = stacked_image_upscaled
-
-        if self.continue_processing[0]:
-            cv2.imwrite(self.output_path, stacked_image_upscaled_deconvolved)
-            self.signal_status_update.emit("finished!")
-    
-        self.signal_finished.emit()
+    ## Upscale and align an image tile by tile, depending on warp_engine and
+    #  out_of_core
+    #  @param raw_image raw image as numpy array
+    #  @param transform_matrices list of transform matrices, one for each tile
+    #  @param image_upscaled upscaled image as numpy float32 array, if it is
+    #  already available. Otherwise, it is upscaled if needed.
+    #  @param distortion_map distortion map as calculated by the
+    #  FlowCalculator or None. If it is given, the dense warp map is used.
+    #  @return generator of tuples (slice of the tile in the upscaled image,
+    #  aligned tile without margins)
+    def warpImageTiles(self, raw_image, transform_matrices, image_upscaled=None,
+                       distortion_map=None):
+        if distortion_map is not None or self.warp_engine == "remap":
+            return self.warpImageRemap(raw_image, transform_matrices, distortion_map)
+        if self.warp_engine == "direct":
+            return self.warpTilesDirect(raw_image, transform_matrices)
+        if image_upscaled is None and self.out_of_core:
+            return self.warpTilesFromRawImage(raw_image, transform_matrices)
+        if image_upscaled is None:
+            with self.instrumentation.measure("upscale"):
+                image_upscaled = CommonFunctions.preprocessImage(raw_image,
+                                                                 self.scale_factor,
+                                                                 interpolation=cv2.INTER_CUBIC)
+        return self.warpTiles(image_upscaled, transform_matrices)
+        
+    ## Add the aligned tiles of an image to a sum and record the times needed
+    #  for warping and for adding separately
+    #  @param stacked_image_upscaled sum of the aligned upscaled images
+    #  @param aligned_tiles generator of tuples (slice of the tile in the
+    #  upscaled image, aligned tile) as returned by warpImageTiles
+    #  @param index index of the image
+    def accumulateImage(self, stacked_image_upscaled, aligned_tiles, index):
+        warp_seconds = 0.
+        accumulate_seconds = 0.
+        start_time = time.perf_counter()
+        for tile_slice, tile_aligned in aligned_tiles:
+            warped_time = time.perf_counter()
+            stacked_image_upscaled[tile_slice] += tile_aligned
+            end_time = time.perf_counter()
+            warp_seconds += warped_time - start_time
+            accumulate_seconds += end_time - warped_time
+            start_time = end_time
+        self.instrumentation.recordEvent("warp", image=index, seconds=warp_seconds)
+        self.instrumentation.recordEvent("accumulate", image=index, seconds=accumulate_seconds)
+        
+    ## Get a function that upscales and aligns the image of a given index
+    #  tile by tile
+    #  @param dataset ImageDataHolder object
+    #  @return callable that takes the index of an image and returns the
+    #  generator of warpImageTiles
+    def warpImageTilesOfIndex(self, dataset):
+        def warpImageTilesOfIndex(index):
+            data = dataset.getData(index)
+            return self.warpImageTiles(data["image"], data["transform_matrix"],
+                                       distortion_map=data["distortion_map"])
+        return warpImageTilesOfIndex
+        
+    ## Measure the distortion of the aligned images by seeing with the
+    #  FlowCalculator and set the distortion maps in the dataset
+    #  @param dataset ImageDataHolder object with filled transform matrices
+    #  @return "aborted" if aborted, else None
+    def calculateDistortionMaps(self, dataset):
+        def getAlignedImage(index):
+            data = dataset.getData(index)
+            return self.warpImageRawResolution(data["image"], data["transform_matrix"])
+        return self.flow_calculator.calculateDistortionMaps(dataset,
+                                                            getAlignedImage,
+                                                            self.createArray,
+                                                            self.continue_processing,
+                                                            self.emitStatus)
 
     ## align and undistort the image.
     #  @param data dictionary of {hdu_list, transform_matrix, distortion_map}
     #  @return processed image as numpy float32 array
     def processImage(self, index, data):
-        # get the image
-        raw_image = CommonFunctions.preprocessImage(data["image"], 
-                                                   self.scale_factor,
-                                                    interpolation=cv2.INTER_CUBIC)
-        image_dimension = raw_image.shape
+        image_dimension = self.calculateUpscaledShape(data["image"].shape)
 
         # create output image as numpy array with upscaled image size
         processed_image = np.zeros(image_dimension, np.float32)
         
         # align all tiles
-        for tile, transform_matrix in zip(self.tiles, data["transform_matrix"]):
+        for tile_slice, tile_aligned in self.warpImageTiles(data["image"],
+                                                            data["transform_matrix"],
+                                                            distortion_map=data["distortion_map"]):
+            processed_image[tile_slice] = tile_aligned
+                                       
+        return processed_image
+        
+    ## Warp the tiles of an upscaled image with their transform matrices
+    #  @param raw_image upscaled image as numpy float32 array
+    #  @param transform_matrices list of transform matrices, one for each tile
+    #  @param tiles list of tiles. If None, self.tiles is used.
+    #  @return generator of tuples (slice of the tile in the upscaled image,
+    #  aligned tile without margins)
+    def warpTiles(self, raw_image, transform_matrices, tiles=None):
+        if tiles is None:
+            tiles = self.tiles
+        for tile, transform_matrix in zip(tiles, transform_matrices):
 
             tile_slice_raw_image = np.s_[tile["y"][0]:tile["y"][1],
                                          tile["x"][0]:tile["x"][1]]
@@ -167,9 +870,156 @@ class ImageStacker(QThread):
                                                
             tile_aligned_without_margin = tile_aligned[tile_aligned_slice]
                                           
-            processed_image[tile_slice_processed_image] = tile_aligned_without_margin
-                                       
-        return processed_image
+            yield tile_slice_processed_image, tile_aligned_without_margin
+            
+    ## Upscale and warp the tiles of a raw image one by one, so that no
+    #  upscaled copy of the whole image is needed
+    #  @param raw_image raw image as numpy array
+    #  @param transform_matrices list of transform matrices, one for each tile
+    #  @return generator of tuples (slice of the tile in the upscaled image,
+    #  aligned tile without margins)
+    def warpTilesFromRawImage(self, raw_image, transform_matrices):
+        raw_image = raw_image.astype(np.float32)
+        for tile, transform_matrix in zip(self.tiles, transform_matrices):
+            raw_image_tile = CommonFunctions.upscaleRegion(raw_image,
+                                                           self.scale_factor,
+                                                           tile["x"],
+                                                           tile["y"])
+            
+            # the tile is warped as if it was cut from the upscaled image
+            tile_upscaled = {"x" : [0, raw_image_tile.shape[1]],
+                             "y" : [0, raw_image_tile.shape[0]],
+                             "margin_x" : tile["margin_x"],
+                             "margin_y" : tile["margin_y"]}
+            for tile_slice, tile_aligned in self.warpTiles(raw_image_tile,
+                                                           [transform_matrix],
+                                                           [tile_upscaled]):
+                min_y = tile["y"][0] + tile["margin_y"][0]
+                min_x = tile["x"][0] + tile["margin_x"][0]
+                tile_slice_stacked_image = np.s_[min_y:min_y + tile_aligned.shape[0],
+                                                 min_x:min_x + tile_aligned.shape[1]]
+                yield tile_slice_stacked_image, tile_aligned
+                
+    ## Interpolate the aligned tiles without margins directly from the raw
+    #  image. Upscaling and alignment are combined into one transform, so the
+    #  image is interpolated only once and no upscaled copy is needed.
+    #  @param raw_image raw image as numpy array
+    #  @param transform_matrices list of transform matrices, one for each tile
+    #  @return generator of tuples (slice of the tile in the upscaled image,
+    #  aligned tile without margins)
+    def warpTilesDirect(self, raw_image, transform_matrices):
+        raw_image = raw_image.astype(np.float32)
+        for tile, transform_matrix in zip(self.tiles, transform_matrices):
+            min_x = tile["x"][0] + tile["margin_x"][0]
+            min_y = tile["y"][0] + tile["margin_y"][0]
+            max_x = tile["x"][1] - tile["margin_x"][1]
+            max_y = tile["y"][1] - tile["margin_y"][1]
+            
+            upscaling_transform_matrix = CommonFunctions.calculateUpscalingTransformMatrix(transform_matrix,
+                                                                                           self.scale_factor,
+                                                                                           [tile["x"][0], tile["y"][0]],
+                                                                                           [min_x, min_y])
+            tile_aligned = cv2.warpAffine(raw_image,
+                                          upscaling_transform_matrix,
+                                          (max_x - min_x, max_y - min_y),
+                                          flags=cv2.INTER_CUBIC + cv2.WARP_INVERSE_MAP,
+                                          borderMode=cv2.BORDER_REPLICATE)
+            yield np.s_[min_y:max_y, min_x:max_x], tile_aligned
+                
+    ## Warp the raw image into the upscaled image with a dense warp map, band
+    #  by band
+    #  @param raw_image raw image as numpy array
+    #  @param transform_matrices list of transform matrices, one for each tile
+    #  @param distortion_map distortion map as calculated by the
+    #  FlowCalculator or None
+    #  @return generator of tuples (slice of the band in the upscaled image,
+    #  aligned band)
+    def warpImageRemap(self, raw_image, transform_matrices, distortion_map=None):
+        raw_image = raw_image.astype(np.float32)
+        warp_map = WarpMap.WarpMap(self.tiles, transform_matrices, self.scale_factor,
+                                   distortion_map)
+        image_dimension_upscaled = self.calculateUpscaledShape(raw_image.shape)
+        width = image_dimension_upscaled[1]
+        for min_y in range(0, image_dimension_upscaled[0], self.remap_band_height):
+            max_y = min(min_y + self.remap_band_height, image_dimension_upscaled[0])
+            map_x, map_y = warp_map.calculateMaps(min_y, max_y, width)
+            band_aligned = cv2.remap(raw_image,
+                                     map_x,
+                                     map_y,
+                                     cv2.INTER_CUBIC,
+                                     borderMode=cv2.BORDER_REPLICATE)
+            yield np.s_[min_y:max_y, 0:width], band_aligned
+                
+    ## Align a raw image without upscaling it, e.g. for measuring the
+    #  remaining distortion
+    #  @param raw_image raw image as numpy array
+    #  @param transform_matrices list of transform matrices, one for each tile
+    #  @return aligned grayscale image at raw resolution as numpy float32 array
+    def warpImageRawResolution(self, raw_image, transform_matrices):
+        if raw_image.ndim == 3:
+            raw_image = cv2.cvtColor(raw_image, cv2.COLOR_BGR2GRAY)
+        raw_image = raw_image.astype(np.float32)
+        warp_map = WarpMap.WarpMap(self.tiles, transform_matrices, self.scale_factor)
+        
+        # coordinates of the raw pixel centers in the upscaled image
+        height, width = raw_image.shape
+        x = (np.arange(width, dtype=np.float32) + 0.5) * self.scale_factor - 0.5
+        image_aligned = np.empty((height, width), np.float32)
+        for min_y in range(0, height, self.remap_band_height):
+            max_y = min(min_y + self.remap_band_height, height)
+            y = (np.arange(min_y, max_y, dtype=np.float32) + 0.5) * self.scale_factor - 0.5
+            map_x, map_y = warp_map.calculateMapsAt(x, y)
+            image_aligned[min_y:max_y] = cv2.remap(raw_image,
+                                                   map_x,
+                                                   map_y,
+                                                   cv2.INTER_CUBIC,
+                                                   borderMode=cv2.BORDER_REPLICATE)
+        return image_aligned
+                
+    ## Create the image the aligned images are summed up in
+    #  @param image_dimension shape of the raw images
+    #  @return numpy float32 array of zeros with upscaled size. If out_of_core
+    #  is set, it is a numpy memmap backed by a temporary file.
+    def createStackedImage(self, image_dimension):
+        return self.createArray(self.calculateUpscaledShape(image_dimension))
+        
+    ## Create an array of zeros for intermediate results
+    #  @param shape shape of the array
+    #  @param dtype data type of the array
+    #  @return numpy array. If out_of_core is set, it is a numpy memmap backed
+    #  by a temporary file.
+    def createArray(self, shape, dtype=np.float32):
+        if not self.out_of_core:
+            return np.zeros(shape, dtype)
+        return self.createScratchArray(shape, dtype)
+        
+    ## Create an array of zeros in a memory mapped temporary file in the
+    #  scratch directory. The file is deleted by closeScratchFiles.
+    #  @param shape shape of the array
+    #  @param dtype data type of the array
+    #  @return numpy memmap
+    def createScratchArray(self, shape, dtype=np.float32):
+        # the file is deleted as soon as it is closed
+        scratch_file = tempfile.NamedTemporaryFile(prefix="verysharp_",
+                                                   suffix=".stack",
+                                                   dir=self.scratch_directory)
+        self.scratch_files.append(scratch_file)
+        return np.memmap(scratch_file, dtype=dtype, mode="w+", shape=shape)
+        
+    def closeScratchFiles(self):
+        for scratch_file in self.scratch_files:
+            scratch_file.close()
+        self.scratch_files = []
+        if self.frame_store is not None:
+            self.frame_store.close()
+            self.frame_store = None
+
+    ## Calculate the shape of an upscaled image
+    #  @param image_dimension shape of the raw image
+    #  @return shape of the upscaled image as tuple
+    def calculateUpscaledShape(self, image_dimension):
+        upscaled_size = np.round(np.multiply(image_dimension[:2], self.scale_factor)).astype(int)
+        return (int(upscaled_size[0]), int(upscaled_size[1])) + tuple(image_dimension[2:])
 
     def calculateTiles(self, image_dimension):
         # todo: also save the effective margins in some way for later processing
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import EventCollector
+import ImageStacker
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+## Runs the ImageStacker engine in a QThread and forwards its status updates
+#  as Qt signals, so that the GUI stays responsive.
+class ImageStackerThread(QThread):
+    signal_finished = pyqtSignal()
+    signal_status_update = pyqtSignal(str)
+    
+    def __init__(self, image_paths, output_path):
+        QThread.__init__(self)
+        self.image_stacker = ImageStacker.ImageStacker(image_paths,
+                                                       output_path,
+                                                       self.emitStatus)
+        
+        # timing events of the last run, e.g. for showing statistics. They
+        # are cleared at the start of each run, so that they do not pile up
+        # if the thread is run several times.
+        self.event_collector = EventCollector.EventCollector()
+        self.image_stacker.instrumentation.addSink(self.event_collector)
+        
+    def __del__(self):
+        self.wait()
+        
+    def run(self):
+        self.event_collector.clear()
+        self.image_stacker.stackImages()
+        self.signal_finished.emit()
+        
+    def abort(self):
+        self.image_stacker.abort()
+        
+    def emitStatus(self, status):
+        self.signal_status_update.emit(status)
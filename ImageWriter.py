@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import queue
+import threading
+import cv2
+
+## Writes images in a background thread, so that encoding and disk I/O
+#  overlap with the processing. At most queue_size images wait for being
+#  written, so memory stays bounded; write blocks while the queue is full.
+class ImageWriter:
+    
+    ## The constructor. The background thread is started immediately.
+    #  @param queue_size number of images that may wait for being written
+    def __init__(self, queue_size=4):
+        self.image_queue = queue.Queue(maxsize=queue_size)
+        self.exception = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        
+    def run(self):
+        while True:
+            item = self.image_queue.get()
+            if item is None:
+                return
+            output_path, image, convert_function = item
+            
+            # after an error, the remaining images are dropped
+            if self.exception is not None:
+                continue
+            try:
+                if convert_function is not None:
+                    image = convert_function(image)
+                if not cv2.imwrite(output_path, image):
+                    print ("could not write ", output_path)
+            except Exception as exception:
+                self.exception = exception
+                
+    ## Queue an image for writing. The image must not be modified afterwards.
+    #  @param output_path path of the image file including file extension
+    #  @param image image as numpy array
+    #  @param convert_function callable that converts the image before it is
+    #  written, e.g. into a visualization. It is called in the background
+    #  thread. May be None.
+    def write(self, output_path, image, convert_function=None):
+        self.image_queue.put((output_path, image, convert_function))
+        
+    ## Wait until all queued images are written and stop the background
+    #  thread. An exception raised while writing is raised again here.
+    def close(self):
+        self.image_queue.put(None)
+        self.thread.join()
+        if self.exception is not None:
+            raise self.exception
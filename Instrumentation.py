@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import threading
+import time
+
+## Records structured events like the time needed to decode an image, to
+#  align a tile or for one deconvolution iteration, and passes them to
+#  pluggable sinks, e.g. a JsonLinesSink for later analysis or an
+#  EventCollector for the GUI. Without sinks, recording does nothing, so
+#  the instrumentation can stay in the inner loops.
+#
+#  An event is a dictionary with the keys "event" (name of the event), "time"
+#  (unix time of the end of the event), "thread" and the fields given by the
+#  caller, e.g. "seconds", "image" or "tile". Sinks need a method
+#  recordEvent(event) and may have a method close().
+#
+#  Events of worker processes are not recorded, as the sinks are not passed
+#  to them.
+class Instrumentation:
+
+    def __init__(self):
+        self.sinks = []
+        
+        # sinks are called by one thread at a time
+        self.lock = threading.Lock()
+
+    # the sinks and the lock are not sent to worker processes
+    def __getstate__(self):
+        return {"sinks" : []}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def addSink(self, sink):
+        with self.lock:
+            self.sinks.append(sink)
+
+    def removeSink(self, sink):
+        with self.lock:
+            self.sinks.remove(sink)
+
+    def isActive(self):
+        return len(self.sinks) > 0
+
+    ## Record an event
+    #  @param event name of the event
+    #  @param fields further fields of the event as keyword arguments
+    def recordEvent(self, event, **fields):
+        if not self.sinks:
+            return
+        record = {"event" : event,
+                  "time" : time.time(),
+                  "thread" : threading.current_thread().name}
+        record.update(fields)
+        with self.lock:
+            for sink in self.sinks:
+                sink.recordEvent(record)
+
+    ## Measure the time of a block of code and record it as an event with the
+    #  field "seconds". Usage:
+    #
+    #      with instrumentation.measure("warp", image=index) as fields:
+    #          ...
+    #          fields["cc"] = cc
+    #
+    #  @param event name of the event
+    #  @param fields further fields of the event as keyword arguments. The
+    #  yielded dictionary of fields may be extended inside the block.
+    @contextlib.contextmanager
+    def measure(self, event, **fields):
+        start_time = time.perf_counter()
+        yield fields
+        if self.sinks:
+            self.recordEvent(event, seconds=time.perf_counter() - start_time, **fields)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+
+## Sink of the Instrumentation that writes each event as one line of JSON
+#  into a file
+class JsonLinesSink:
+
+    ## The constructor
+    #  @param path path of the file. An existing file is overwritten.
+    def __init__(self, path):
+        self.file = open(path, "w")
+
+    def recordEvent(self, event):
+        # numpy scalars are written as plain numbers
+        self.file.write(json.dumps(event, default=float) + "\n")
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import cv2
+import numpy as np
+import CommonFunctions
+
+## Stacks frames one at a time as they arrive, e.g. from a time-lapse rig,
+#  without reprocessing the frames stacked before. The first frame is the
+#  reference. The tile layout, the upscaled reference with its precomputed
+#  alignment data and the running sum with its frame count are kept, so that
+#  adding a frame costs the alignment and warping of that frame only. The
+#  mean or a deconvolved preview can be requested at any time, also from
+#  another thread than the one adding frames.
+#
+#  The settings are taken from an ImageStacker, whose aligner, warp engine,
+#  out-of-core mode and deconvolver are used. Frames are averaged, the
+#  robust stacking modes and seeing correction need all frames at once and
+#  are not available.
+class LiveStackingSession:
+
+    ## The constructor
+    #  @param image_stacker configured ImageStacker object providing the
+    #  settings. Its image paths are not used. Seeing correction and the
+    #  robust stacking modes are rejected with a ValueError.
+    def __init__(self, image_stacker):
+        if image_stacker.correct_seeing:
+            raise ValueError("seeing correction is not available for live stacking")
+        if image_stacker.stacking_mode != "mean":
+            raise ValueError("stacking mode " + image_stacker.stacking_mode
+                             + " is not available for live stacking")
+        self.image_stacker = image_stacker
+        self.image_dimension = None
+        self.stacked_image_upscaled = None
+        self.num_frames = 0
+
+        # correlation coefficients of the tiles of each added frame
+        self.correlation_coefficients = []
+
+        # guards the running sum and the frame count
+        self.lock = threading.Lock()
+
+    ## Align a frame and add it to the stack. The first frame becomes the
+    #  reference.
+    #  @param image decoded frame as numpy array
+    #  @return list of the correlation coefficients of the tiles or
+    #  "aborted"
+    def addFrame(self, image):
+        image_stacker = self.image_stacker
+        image_upscaled = CommonFunctions.preprocessImage(image,
+                                                         image_stacker.scale_factor,
+                                                         interpolation=cv2.INTER_CUBIC)
+        image_upscaled_8u = CommonFunctions.convertToUint8(image_upscaled)
+
+        if self.image_dimension is None:
+            self.initialize(image.shape, image_upscaled_8u)
+            transform_matrices = [np.eye(2, 3, dtype=np.float32) for tile in image_stacker.tiles]
+            correlation_coefficients = [1. for tile in image_stacker.tiles]
+        else:
+            if image.shape != self.image_dimension:
+                raise ValueError("frame has shape " + str(image.shape)
+                                 + " instead of " + str(self.image_dimension))
+            alignment_result = image_stacker.image_aligner.alignUpscaledImage(image_upscaled_8u,
+                                                                              image_stacker.continue_processing,
+                                                                              image_stacker.emitStatus)
+            if alignment_result == "aborted":
+                return "aborted"
+            transform_matrices, correlation_coefficients = alignment_result
+        del image_upscaled_8u
+
+        # add the aligned tiles to the stack without creating a full size
+        # aligned image
+        with self.lock:
+            image_stacker.accumulateImage(self.stacked_image_upscaled,
+                                          image_stacker.warpImageTiles(image,
+                                                                       transform_matrices,
+                                                                       image_upscaled),
+                                          self.num_frames)
+            self.num_frames += 1
+            self.correlation_coefficients.append(correlation_coefficients)
+
+        print ("stacked frame ", self.num_frames)
+        image_stacker.emitStatus("stacked frame " + str(self.num_frames))
+        return correlation_coefficients
+
+    ## Read a frame from a file, align it and add it to the stack
+    #  @param image_path path of the frame
+    #  @return list of the correlation coefficients of the tiles or
+    #  "aborted"
+    def addFrameFromPath(self, image_path):
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError("could not read " + image_path)
+        return self.addFrame(image)
+
+    ## Set up the tiles, the reference and the running sum from the first
+    #  frame
+    #  @param image_dimension shape of the raw frames
+    #  @param reference_image_upscaled upscaled first frame as 8 bit numpy
+    #  array
+    def initialize(self, image_dimension, reference_image_upscaled):
+        image_stacker = self.image_stacker
+        image_stacker.image_aligner.scale_factor = image_stacker.scale_factor
+        image_stacker.tiles = image_stacker.calculateTiles(image_dimension)
+        image_stacker.image_aligner.setUpscaledReference(reference_image_upscaled,
+                                                         image_stacker.tiles)
+        self.stacked_image_upscaled = image_stacker.createStackedImage(image_dimension)
+        self.image_dimension = image_dimension
+
+    ## Get the mean of the frames stacked so far
+    #  @return mean as numpy float32 array or None if no frame has been added
+    def getMean(self):
+        with self.lock:
+            if self.num_frames == 0:
+                return None
+            return self.stacked_image_upscaled / np.float32(self.num_frames)
+
+    ## Get a preview of the stack, optionally deconvolved with the
+    #  deconvolver of the ImageStacker
+    #  @param deconvolve if True, the mean is deconvolved
+    #  @return preview as numpy float32 array, None if no frame has been added
+    #  or "aborted"
+    def getPreview(self, deconvolve=True):
+        mean = self.getMean()
+        if mean is None or not deconvolve:
+            return mean
+        return self.image_stacker.deconvolver.deconvolveLucy(mean,
+                                                             self.image_stacker.continue_processing,
+                                                             self.image_stacker.emitStatus)
+
+    ## Release the running sum and its scratch file, if there is one
+    def close(self):
+        with self.lock:
+            self.stacked_image_upscaled = None
+        self.image_stacker.closeScratchFiles()
@@ -23,7 +23,7 @@ from PyQt5.QtWidgets import (QWidget, QPushButton, QLineEdit, QFileDialog,
 from PyQt5.QtGui import QIcon
 from PyQt5.QtCore import pyqtSlot, pyqtSignal
 import configparser
-import ImageStacker
+import ImageStackerThread
 
 # TODO: make input and output dialog folders persistent!
 
@@ -115,7 +115,7 @@ class MainWindow(QWidget):
             self.button_process.setEnabled(False)
             
             self.progress_box = self.showProcessingBox()
-            self.stacker = ImageStacker.ImageStacker(self.filepaths, output_path)
+            self.stacker = ImageStackerThread.ImageStackerThread(self.filepaths, output_path)
             self.stacker.signal_finished.connect(self.processing_finished)
             self.stacker.signal_status_update.connect(self.progress_box.setInformativeText)
             
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+## Combines aligned images while rejecting outliers like satellites, birds or
+#  misaligned tiles, which show up as ghosts in a plain average. The aligned
+#  images are passed in tile by tile, so that only one tile of one image is
+#  held in memory at a time in addition to the intermediate arrays. These
+#  have the size of the upscaled image and are created by createArray, so
+#  they are only kept on disk instead of in memory in out-of-core mode.
+#
+#  "sigma_clip" calculates mean and standard deviation of each pixel with
+#  Welford's algorithm in a first pass and averages only the values within
+#  kappa standard deviations in a second pass. As a single outlier deviates
+#  at most sqrt(n - 1) standard deviations from the mean of n images, at
+#  least kappa^2 + 1 images are needed for anything to be rejected. It needs
+#  three float32 arrays and one uint16 array of the size of the upscaled
+#  image.
+#
+#  "median" writes the aligned images into a memory mapped stack and
+#  calculates the median block by block into one float32 array of the size
+#  of the upscaled image.
+class RobustStacker:
+
+    ## The constructor
+    #  @param mode "sigma_clip" or "median"
+    def __init__(self, mode="sigma_clip"):
+        self.mode = mode
+        self.kappa = 2.5
+
+        # edge length of the blocks that are processed at once. The median
+        # needs num_images * block_size^2 * channels * 4 bytes per block.
+        self.block_size = 256
+
+    ## Combine the aligned images
+    #  @param num_images number of images
+    #  @param shape shape of the upscaled image
+    #  @param getAlignedTiles callable that takes the index of an image and
+    #  returns a generator of tuples (slice in the upscaled image, aligned
+    #  tile) covering the whole image
+    #  @param createArray callable that takes a shape and a dtype and returns
+    #  an array of zeros for intermediate results
+    #  @param createScratchArray callable that takes a shape and a dtype and
+    #  returns a memory mapped array of zeros
+    #  @param continue_processing list with one bool; processing is aborted if
+    #  it is set to False
+    #  @param status_callback callable that is called with a status string
+    #  @return combined image as numpy float32 array or "aborted"
+    def stackImages(self, num_images, shape, getAlignedTiles, createArray,
+                    createScratchArray, continue_processing, status_callback):
+        if self.mode == "median":
+            return self.stackImagesMedian(num_images, shape, getAlignedTiles,
+                                          createArray, createScratchArray,
+                                          continue_processing, status_callback)
+        return self.stackImagesSigmaClip(num_images, shape, getAlignedTiles,
+                                         createArray, continue_processing,
+                                         status_callback)
+
+    ## Average the images with sigma clipping in two passes
+    #  @return combined image as numpy float32 array or "aborted"
+    def stackImagesSigmaClip(self, num_images, shape, getAlignedTiles,
+                             createArray, continue_processing, status_callback):
+        mean = createArray(shape, np.float32)
+
+        # sum of squared differences from the mean. It is turned into the
+        # clipping threshold after the first pass.
+        squared_deviations = createArray(shape, np.float32)
+
+        for index in range(num_images):
+            if continue_processing[0] == False:
+                return "aborted"
+            print ("calculating statistics of image ", index)
+            status_callback("calculating statistics of image " + str(index + 1)
+                            + " of " + str(num_images))
+
+            for tile_slice, tile_aligned in getAlignedTiles(index):
+                mean_tile = mean[tile_slice]
+                delta = tile_aligned - mean_tile
+                mean_tile += delta / (index + 1)
+                squared_deviations[tile_slice] += delta * (tile_aligned - mean_tile)
+
+        threshold = squared_deviations
+        for block_slice in self.iterateBlocks(shape):
+            threshold_block = threshold[block_slice]
+            np.sqrt(threshold_block / num_images, out=threshold_block)
+            threshold_block *= self.kappa
+
+        clipped_sum = createArray(shape, np.float32)
+        counts = createArray(shape, np.uint16)
+
+        for index in range(num_images):
+            if continue_processing[0] == False:
+                return "aborted"
+            print ("rejecting outliers of image ", index)
+            status_callback("rejecting outliers of image " + str(index + 1)
+                            + " of " + str(num_images))
+
+            for tile_slice, tile_aligned in getAlignedTiles(index):
+                accepted = np.abs(tile_aligned - mean[tile_slice]) <= threshold[tile_slice]
+                clipped_sum[tile_slice] += np.where(accepted, tile_aligned, 0.)
+                counts[tile_slice] += accepted
+
+        # pixels where all values were rejected, e.g. due to rounding errors
+        # in constant areas, get the plain mean
+        for block_slice in self.iterateBlocks(shape):
+            counts_block = counts[block_slice]
+            clipped_sum_block = clipped_sum[block_slice]
+            np.divide(clipped_sum_block, counts_block, out=clipped_sum_block,
+                      where=counts_block > 0)
+            np.copyto(clipped_sum_block, mean[block_slice],
+                      where=counts_block == 0)
+
+        return clipped_sum
+
+    ## Calculate the median of the images block by block
+    #  @return combined image as numpy float32 array or "aborted"
+    def stackImagesMedian(self, num_images, shape, getAlignedTiles,
+                          createArray, createScratchArray,
+                          continue_processing, status_callback):
+        frame_stack = createScratchArray((num_images,) + tuple(shape), np.float32)
+
+        for index in range(num_images):
+            if continue_processing[0] == False:
+                return "aborted"
+            print ("writing image ", index, " to the frame stack")
+            status_callback("writing image " + str(index + 1) + " of "
+                            + str(num_images) + " to the frame stack")
+
+            for tile_slice, tile_aligned in getAlignedTiles(index):
+                frame_stack[(index,) + tile_slice] = tile_aligned
+
+        median = createArray(shape, np.float32)
+        block_slices = list(self.iterateBlocks(shape))
+        for block_index, block_slice in enumerate(block_slices):
+            if continue_processing[0] == False:
+                return "aborted"
+            status_callback("calculating median of block " + str(block_index + 1)
+                            + " of " + str(len(block_slices)))
+            np.median(frame_stack[(slice(None),) + block_slice], axis=0,
+                      out=median[block_slice])
+
+        return median
+
+    ## Split an image into square blocks
+    #  @param shape shape of the image
+    #  @return generator of slices of the blocks
+    def iterateBlocks(self, shape):
+        for min_y in range(0, shape[0], self.block_size):
+            for min_x in range(0, shape[1], self.block_size):
+                yield np.s_[min_y:min_y + self.block_size,
+                            min_x:min_x + self.block_size]
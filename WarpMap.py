@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cv2
+import numpy as np
+import CommonFunctions
+
+## Dense warp map of an image built from the transform matrices of its
+#  tiles. Only the affine parameters at the tile centers are stored. They are
+#  interpolated bilinearly between the tile centers when the maps for
+#  cv2.remap are calculated, so that the warp changes smoothly between tiles
+#  instead of jumping at the tile borders.
+#
+#  Optionally, a distortion map as calculated by FlowCalculator is applied in
+#  the same interpolation.
+class WarpMap:
+
+    ## The constructor
+    #  @param tiles list of tiles as calculated by ImageStacker.calculateTiles
+    #  @param transform_matrices list of transform matrices, one for each tile
+    #  @param scale_factor upscaling factor of the tiles
+    #  @param distortion_map optical flow of shape (height, width, 2) at raw
+    #  resolution that is applied to the aligned image, or None
+    def __init__(self, tiles, transform_matrices, scale_factor, distortion_map=None):
+        self.scale_factor = scale_factor
+        self.distortion_map = distortion_map
+
+        # the maps are calculated exactly on a grid with this spacing and
+        # interpolated linearly in between. This is much faster and deviates
+        # by a few hundredths of a pixel at most, where the transforms of
+        # neighbouring tiles differ strongly.
+        self.map_step = 8
+
+        # the tiles are ordered row by row
+        num_tiles_x = sum(1 for tile in tiles if tile["y"] == tiles[0]["y"])
+        num_tiles_y = len(tiles) // num_tiles_x
+
+        # affine parameters of each tile in coordinates of the whole upscaled
+        # image instead of the tile
+        self.grid = np.empty((num_tiles_y, num_tiles_x, 6), np.float32)
+        for index, (tile, transform_matrix) in enumerate(zip(tiles, transform_matrices)):
+            transform_matrix_image = CommonFunctions.convertTransformMatrix(transform_matrix,
+                                                                           1.,
+                                                                           [tile["x"][0], tile["y"][0]])
+            self.grid[index // num_tiles_x, index % num_tiles_x] = transform_matrix_image.ravel()
+
+        # the distortion is small, so the change of the affine transforms
+        # along a distortion vector is neglected
+        self.linear_part_mean = self.grid[..., [0, 1, 3, 4]].reshape(-1, 2, 2).mean(axis=0)
+
+        # centers of the tiles without margins
+        self.centers_x = np.array([self.calculateCenter(tile["x"], tile["margin_x"])
+                                   for tile in tiles[:num_tiles_x]])
+        self.centers_y = np.array([self.calculateCenter(tile["y"], tile["margin_y"])
+                                   for tile in tiles[::num_tiles_x]])
+
+    ## Calculate the center of a tile without margins along one axis
+    #  @param tile_range [min, max] of the tile including margins
+    #  @param margins [left, right] margins of the tile
+    #  @return center coordinate
+    def calculateCenter(self, tile_range, margins):
+        return ((tile_range[0] + margins[0]) + (tile_range[1] - margins[1]) - 1) / 2.
+
+    ## Calculate the interpolation indices and weights of pixels between the
+    #  tile centers along one axis. Outside the outermost centers, the
+    #  parameters of the outermost tiles are used.
+    #  @param coordinates pixel coordinates as numpy array
+    #  @param centers tile centers along the axis
+    #  @return tuple (lower indices, upper indices, weights of the upper
+    #  indices)
+    def calculateInterpolationWeights(self, coordinates, centers):
+        grid_coordinates = np.interp(coordinates, centers, np.arange(len(centers)))
+        lower_indices = np.floor(grid_coordinates).astype(int)
+        upper_indices = np.minimum(lower_indices + 1, len(centers) - 1)
+        weights = (grid_coordinates - lower_indices).astype(np.float32)
+        return lower_indices, upper_indices, weights
+
+    ## Calculate the maps for cv2.remap for a band of rows of the upscaled
+    #  image. The maps point into the raw image, so that upscaling and
+    #  alignment are done with a single interpolation.
+    #  @param min_y first row of the band
+    #  @param max_y row after the last row of the band
+    #  @param width width of the upscaled image
+    #  @return tuple (map_x, map_y) as numpy float32 arrays with shape
+    #  (max_y - min_y, width)
+    def calculateMaps(self, min_y, max_y, width):
+        step = self.map_step
+        
+        # sample the centers of step x step blocks with one additional block
+        # on each side, so that cv2.resize interpolates between the samples
+        # without extrapolating at the borders
+        num_samples_x = int(np.ceil(width / step)) + 2
+        num_samples_y = int(np.ceil((max_y - min_y) / step)) + 2
+        x = (np.arange(num_samples_x, dtype=np.float32) - 0.5) * step - 0.5
+        y = min_y + (np.arange(num_samples_y, dtype=np.float32) - 0.5) * step - 0.5
+        map_x_samples, map_y_samples = self.calculateMapsAt(x, y)
+        
+        size = (num_samples_x * step, num_samples_y * step)
+        band_slice = np.s_[step:step + max_y - min_y, step:step + width]
+        map_x = cv2.resize(map_x_samples, size, interpolation=cv2.INTER_LINEAR)[band_slice]
+        map_y = cv2.resize(map_y_samples, size, interpolation=cv2.INTER_LINEAR)[band_slice]
+        map_x = np.ascontiguousarray(map_x)
+        map_y = np.ascontiguousarray(map_y)
+        
+        if self.distortion_map is not None:
+            # sample the aligned image at p + distortion(p) instead of p
+            distortion = self.calculateDistortion(min_y, max_y, width)
+            linear_part = self.linear_part_mean
+            map_x += linear_part[0, 0] * distortion[..., 0] + linear_part[0, 1] * distortion[..., 1]
+            map_y += linear_part[1, 0] * distortion[..., 0] + linear_part[1, 1] * distortion[..., 1]
+        return map_x, map_y
+
+    ## Upscale the distortion map for a band of rows of the upscaled image
+    #  @param min_y first row of the band
+    #  @param max_y row after the last row of the band
+    #  @param width width of the upscaled image
+    #  @return distortion in pixels of the raw image as numpy float32 array of
+    #  shape (max_y - min_y, width, 2)
+    def calculateDistortion(self, min_y, max_y, width):
+        # coordinates of the pixels of the band in the distortion map
+        x = (np.arange(width, dtype=np.float32) + 0.5) / self.scale_factor - 0.5
+        y = (np.arange(min_y, max_y, dtype=np.float32) + 0.5) / self.scale_factor - 0.5
+        
+        # only convert the rows of the distortion map needed for the band
+        min_row = max(int(np.floor(y[0])) - 1, 0)
+        max_row = min(int(np.ceil(y[-1])) + 2, self.distortion_map.shape[0])
+        distortion_map_rows = np.asarray(self.distortion_map[min_row:max_row], dtype=np.float32)
+        
+        map_x, map_y = np.meshgrid(x, y - min_row)
+        return cv2.remap(distortion_map_rows, map_x, map_y, cv2.INTER_LINEAR,
+                         borderMode=cv2.BORDER_REPLICATE)
+
+    ## Calculate the maps for cv2.remap exactly for a grid of pixels
+    #  @param x x coordinates of the grid in the upscaled image
+    #  @param y y coordinates of the grid in the upscaled image
+    #  @return tuple (map_x, map_y) of coordinates in the raw image as numpy
+    #  float32 arrays with shape (len(y), len(x))
+    def calculateMapsAt(self, x, y):
+        lower_y, upper_y, weights_y = self.calculateInterpolationWeights(y, self.centers_y)
+        lower_x, upper_x, weights_x = self.calculateInterpolationWeights(x, self.centers_x)
+
+        # interpolate along y first, then along x
+        weights_y = weights_y[:, np.newaxis, np.newaxis]
+        parameters_rows = ((1. - weights_y) * self.grid[lower_y]
+                           + weights_y * self.grid[upper_y])
+        weights_x = weights_x[np.newaxis, :, np.newaxis]
+        parameters = ((1. - weights_x) * parameters_rows[:, lower_x]
+                      + weights_x * parameters_rows[:, upper_x])
+
+        x = x[np.newaxis, :]
+        y = y[:, np.newaxis]
+        map_x = parameters[..., 0] * x + parameters[..., 1] * y + parameters[..., 2]
+        map_y = parameters[..., 3] * x + parameters[..., 4] * y + parameters[..., 5]
+
+        # map the pixel centers of the upscaled image to the raw image in the
+        # same way cv2.resize does
+        map_x = (map_x + 0.5) / self.scale_factor - 0.5
+        map_y = (map_y + 0.5) / self.scale_factor - 0.5
+        return map_x.astype(np.float32), map_y.astype(np.float32)
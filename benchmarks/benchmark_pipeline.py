@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+## Benchmark the stages of the pipeline on synthetic bursts with known
+#  transforms, blur and noise at several resolutions and frame counts. The
+#  alignment, the optional seeing correction, the warping and summing of the
+#  images with ImageStacker.processImage and the deconvolution are timed
+#  separately. The recovered transform matrices are checked against the
+#  true ones. Each configuration runs in a fresh process, so that the peak
+#  memory after each stage is not influenced by the other configurations.
+#
+#  The results are written to a JSON file. If a previous result file is
+#  passed with --compare, the relative changes of the timings and errors
+#  are printed.
+#
+#  usage: python benchmarks/benchmark_pipeline.py --sizes 300x400 600x800
+#         --images 4 8 --output results.json [--compare baseline.json]
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import CommonFunctions
+import ImageDataHolder
+import ImageStacker
+import synthetic_burst
+
+## Get the peak resident memory of the current process
+#  @return peak memory in MB
+def getPeakMemory():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+## Calculate the error of the recovered transform matrices of the tiles
+#  @param dataset ImageDataHolder object with filled transform matrices
+#  @param tiles list of tiles as calculated by ImageStacker.calculateTiles
+#  @param true_transform_matrices true transform matrices of the images at raw
+#  resolution
+#  @param scale_factor upscaling factor
+#  @return dictionary of {mean, max, failed_tiles}. The errors are the
+#  distances between the true and the recovered positions of the corners
+#  and the center of the tiles without margins in raw pixels.
+def calculateAlignmentError(dataset, tiles, true_transform_matrices, scale_factor):
+    # the pixel centers of the upscaled image as cv2.resize places them
+    offset = 0.5 * (scale_factor - 1.)
+    errors = []
+    failed_tiles = 0
+    for index in range(1, dataset.getImageCount()):
+        true_transform_matrix = CommonFunctions.convertTransformMatrix(true_transform_matrices[index],
+                                                                       scale_factor,
+                                                                       [offset, offset])
+        for tile, transform_matrix, correlation_coefficient in zip(tiles,
+                                                                   dataset.transform_matrices[index],
+                                                                   dataset.correlation_coefficients[index]):
+            if correlation_coefficient is None:
+                failed_tiles += 1
+                continue
+            transform_matrix_image = CommonFunctions.convertTransformMatrix(transform_matrix,
+                                                                           1.,
+                                                                           [tile["x"][0], tile["y"][0]])
+            min_x = tile["x"][0] + tile["margin_x"][0]
+            max_x = tile["x"][1] - tile["margin_x"][1] - 1
+            min_y = tile["y"][0] + tile["margin_y"][0]
+            max_y = tile["y"][1] - tile["margin_y"][1] - 1
+            points = np.array([[min_x, min_y, 1.],
+                               [max_x, min_y, 1.],
+                               [min_x, max_y, 1.],
+                               [max_x, max_y, 1.],
+                               [(min_x + max_x) / 2., (min_y + max_y) / 2., 1.]])
+            difference = (np.dot(points, transform_matrix_image.T.astype(np.float64))
+                          - np.dot(points, true_transform_matrix.T.astype(np.float64)))
+            errors.append(np.max(np.hypot(difference[:, 0], difference[:, 1])) / scale_factor)
+
+    return {"mean" : float(np.mean(errors)) if errors else None,
+            "max" : float(np.max(errors)) if errors else None,
+            "failed_tiles" : failed_tiles}
+
+## Run the stages of the pipeline in the current process
+#  @param burst dictionary as returned by synthetic_burst.createSyntheticBurst
+#  @param options dictionary of command line options
+#  @return dictionary of {stages, alignment_error}. stages maps the name of
+#  each stage to {seconds, peak_memory_mb}, where the peak memory is that of
+#  the process up to the end of the stage.
+def runPipeline(burst, options):
+    image_stacker = ImageStacker.ImageStacker(burst["paths"], None)
+    image_stacker.scale_factor = options["scale_factor"]
+    image_stacker.tile_size = options["tile_size"]
+    image_stacker.tile_margin = options["tile_margin"]
+    image_stacker.warp_engine = options["warp_engine"]
+    image_stacker.image_aligner.scale_factor = options["scale_factor"]
+    image_stacker.image_aligner.alignment_method = options["alignment_method"]
+    image_stacker.image_aligner.num_workers = options["alignment_workers"]
+    continue_processing = image_stacker.continue_processing
+    status_callback = lambda status: None
+
+    dataset = ImageDataHolder.ImageDataHolder(burst["paths"])
+    image_dimension = dataset.getImageSize(0)
+    image_stacker.tiles = image_stacker.calculateTiles(image_dimension)
+
+    stages = {}
+    def runStage(name, function):
+        start_time = time.perf_counter()
+        result = function()
+        stages[name] = {"seconds" : time.perf_counter() - start_time,
+                        "peak_memory_mb" : getPeakMemory()}
+        return result
+
+    runStage("alignment",
+             lambda: image_stacker.image_aligner.calculateTransformationMatrices(dataset,
+                                                                                 image_stacker.tiles,
+                                                                                 continue_processing,
+                                                                                 status_callback))
+    if options["correct_seeing"]:
+        image_stacker.correct_seeing = True
+        runStage("seeing", lambda: image_stacker.calculateDistortionMaps(dataset))
+
+    def stack():
+        stacked_image = image_stacker.createStackedImage(image_dimension)
+        for index in range(dataset.getImageCount()):
+            stacked_image += image_stacker.processImage(index, dataset.getData(index))
+        return stacked_image / dataset.getImageCount()
+    stacked_image = runStage("stacking", stack)
+
+    runStage("deconvolution",
+             lambda: image_stacker.deconvolver.deconvolveLucy(stacked_image,
+                                                              continue_processing,
+                                                              status_callback))
+
+    return {"stages" : stages,
+            "alignment_error" : calculateAlignmentError(dataset,
+                                                        image_stacker.tiles,
+                                                        burst["transform_matrices"],
+                                                        options["scale_factor"])}
+
+## Run runPipeline in a fresh process
+def runPipelineInProcess(burst, options):
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(runPipeline, burst, options).result()
+
+## Print the relative changes of the results compared to previous results
+#  @param results list of result dictionaries
+#  @param previous_results list of result dictionaries of a previous run
+def printComparison(results, previous_results):
+    def getConfiguration(result):
+        return (result["height"], result["width"], result["num_images"])
+    previous_results = {getConfiguration(result) : result for result in previous_results}
+
+    def formatChange(value, previous_value):
+        if value is None or not previous_value:
+            return "%10s" % "-"
+        return "%+9.1f%%" % (100. * (value - previous_value) / previous_value)
+
+    print ("")
+    print ("changes compared to the previous results:")
+    for result in results:
+        previous_result = previous_results.get(getConfiguration(result))
+        if previous_result is None:
+            continue
+        for name, stage in result["stages"].items():
+            previous_stage = previous_result["stages"].get(name)
+            if previous_stage is None:
+                continue
+            print ("%5dx%-5d %4d images %-14s time %s   memory %s" % (result["height"],
+                                                                   result["width"],
+                                                                   result["num_images"],
+                                                                   name,
+                                                                   formatChange(stage["seconds"],
+                                                                                previous_stage["seconds"]),
+                                                                   formatChange(stage["peak_memory_mb"],
+                                                                                previous_stage["peak_memory_mb"])))
+        print ("%5dx%-5d %4d images %-14s mean %s" % (result["height"],
+                                                       result["width"],
+                                                       result["num_images"],
+                                                       "alignment error",
+                                                       formatChange(result["alignment_error"]["mean"],
+                                                                    previous_result["alignment_error"]["mean"])))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the "
+                                                 "pipeline on synthetic bursts.")
+    parser.add_argument("--sizes", nargs="+", default=["300x400", "600x800"],
+                        help="resolutions of the bursts as HEIGHTxWIDTH")
+    parser.add_argument("--images", type=int, nargs="+", default=[4, 8],
+                        help="frame counts of the bursts")
+    parser.add_argument("--max-shift", type=float, default=3.)
+    parser.add_argument("--max-rotation", type=float, default=0.5,
+                        help="maximum rotation of the frames in degrees")
+    parser.add_argument("--blur-sigma", type=float, default=1.)
+    parser.add_argument("--noise-sigma", type=float, default=2.)
+    parser.add_argument("--scale-factor", type=float, default=2.)
+    parser.add_argument("--tile-size", type=int, default=512)
+    parser.add_argument("--tile-margin", type=int, default=128)
+    parser.add_argument("--warp-engine", choices=["tiles", "direct", "remap"], default="tiles")
+    parser.add_argument("--alignment-method", choices=["ecc", "pyramid"], default="ecc")
+    parser.add_argument("--alignment-workers", type=int, default=1)
+    parser.add_argument("--correct-seeing", action="store_true",
+                        help="also benchmark the seeing correction")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="path of the JSON result file")
+    parser.add_argument("--compare", default=None,
+                        help="JSON result file of a previous run to compare with")
+    args = parser.parse_args()
+
+    options = {"scale_factor" : args.scale_factor,
+               "tile_size" : args.tile_size,
+               "tile_margin" : args.tile_margin,
+               "warp_engine" : args.warp_engine,
+               "alignment_method" : args.alignment_method,
+               "alignment_workers" : args.alignment_workers,
+               "correct_seeing" : args.correct_seeing}
+    burst_options = {"max_shift" : args.max_shift,
+                     "max_rotation" : args.max_rotation,
+                     "blur_sigma" : args.blur_sigma,
+                     "noise_sigma" : args.noise_sigma,
+                     "seed" : args.seed}
+
+    results = []
+    print ("%-11s %6s %-14s %10s %10s %12s %12s" % ("size", "images", "stage",
+                                                     "seconds", "peak MB",
+                                                     "mean error", "max error"))
+    with tempfile.TemporaryDirectory(prefix="verysharp_benchmark_") as directory:
+        for size in args.sizes:
+            height, width = [int(value) for value in size.split("x")]
+            for num_images in args.images:
+                burst = synthetic_burst.createSyntheticBurst(os.path.join(directory,
+                                                                          "%s_%d" % (size, num_images)),
+                                                             height, width, num_images,
+                                                             **burst_options)
+                result = runPipelineInProcess(burst, options)
+                result.update({"height" : height,
+                               "width" : width,
+                               "num_images" : num_images})
+                results.append(result)
+
+                alignment_error = result["alignment_error"]
+                for name, stage in result["stages"].items():
+                    errors = ("", "")
+                    if name == "alignment" and alignment_error["mean"] is not None:
+                        errors = ("%.4f" % alignment_error["mean"],
+                                  "%.4f" % alignment_error["max"])
+                    print ("%-11s %6d %-14s %10.2f %10.1f %12s %12s" % (size, num_images, name,
+                                                                         stage["seconds"],
+                                                                         stage["peak_memory_mb"],
+                                                                         errors[0], errors[1]))
+
+    output = {"options" : options,
+              "burst_options" : burst_options,
+              "environment" : {"python" : platform.python_version(),
+                               "numpy" : np.__version__,
+                               "opencv" : cv2.__version__,
+                               "platform" : platform.platform(),
+                               "cpu_count" : os.cpu_count()},
+              "results" : results}
+    with open(args.output, "w") as output_file:
+        json.dump(output, output_file, indent=2)
+    print ("results written to ", args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as compare_file:
+            printComparison(results, json.load(compare_file)["results"])
+
+if __name__ == "__main__":
+    main()
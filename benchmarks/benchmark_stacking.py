@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+## Compare the stacking modes on a synthetic burst with outliers. Each mode is
+#  run in a fresh process to measure its peak memory. The error is measured
+#  against the mean of the same burst without outliers.
+#
+#  usage: python benchmarks/benchmark_stacking.py [--height 600 --width 800 ...]
+
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ImageStacker
+import synthetic_burst
+
+## Stack images in the current process
+#  @param image_paths list of paths of the images
+#  @param output_path path of the output image
+#  @param stacking_mode stacking mode of the ImageStacker
+#  @param options dictionary of command line options
+#  @return tuple (seconds, peak resident memory in MB)
+def runStacker(image_paths, output_path, stacking_mode, options):
+    image_stacker = ImageStacker.ImageStacker(image_paths, output_path)
+    image_stacker.scale_factor = options["scale_factor"]
+    image_stacker.tile_size = options["tile_size"]
+    image_stacker.tile_margin = options["tile_margin"]
+    image_stacker.out_of_core = options["out_of_core"]
+    image_stacker.bool_deconvolve = False
+    image_stacker.stacking_mode = stacking_mode
+    
+    start_time = time.perf_counter()
+    image_stacker.stackImages()
+    seconds = time.perf_counter() - start_time
+    
+    # ru_maxrss is in kB on Linux
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return seconds, peak_memory
+
+## Run runStacker in a fresh process, so that the peak memory of the runs
+#  does not influence each other
+def runStackerInProcess(image_paths, output_path, stacking_mode, options):
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(runStacker, image_paths, output_path,
+                               stacking_mode, options).result()
+
+## Calculate the root mean square error of an image
+#  @param image image as numpy array
+#  @param reference reference image as numpy array
+#  @param box (min_x, min_y, max_x, max_y) region to compare. None compares
+#  the whole image.
+def calculateError(image, reference, box=None):
+    difference = image.astype(np.float32) - reference.astype(np.float32)
+    if box is not None:
+        difference = difference[box[1]:box[3], box[0]:box[2]]
+    return float(np.sqrt(np.mean(np.square(difference))))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stacking modes "
+                                                 "on a synthetic burst.")
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--images", type=int, default=12)
+    parser.add_argument("--outliers", type=int, default=3,
+                        help="number of frames with an outlier blob")
+    parser.add_argument("--scale-factor", type=float, default=2.)
+    parser.add_argument("--tile-size", type=int, default=512)
+    parser.add_argument("--tile-margin", type=int, default=128)
+    parser.add_argument("--out-of-core", action="store_true")
+    parser.add_argument("--modes", nargs="+", default=["mean", "sigma_clip", "median"])
+    args = parser.parse_args()
+    
+    options = {"scale_factor" : args.scale_factor,
+               "tile_size" : args.tile_size,
+               "tile_margin" : args.tile_margin,
+               "out_of_core" : args.out_of_core}
+    
+    with tempfile.TemporaryDirectory(prefix="verysharp_benchmark_") as directory:
+        clean_burst = synthetic_burst.createSyntheticBurst(os.path.join(directory, "clean"),
+                                                           args.height, args.width,
+                                                           args.images)
+        burst = synthetic_burst.createSyntheticBurst(os.path.join(directory, "outliers"),
+                                                     args.height, args.width,
+                                                     args.images,
+                                                     num_outliers=args.outliers)
+        
+        reference_path = os.path.join(directory, "reference.png")
+        runStackerInProcess(clean_burst["paths"], reference_path, "mean", options)
+        reference = cv2.imread(reference_path)
+        
+        print ("%-12s %10s %12s %12s %14s" % ("mode", "seconds", "peak MB",
+                                              "rms error", "outlier error"))
+        for stacking_mode in args.modes:
+            output_path = os.path.join(directory, stacking_mode + ".png")
+            seconds, peak_memory = runStackerInProcess(burst["paths"], output_path,
+                                                       stacking_mode, options)
+            result = cv2.imread(output_path)
+            
+            outlier_errors = []
+            for box in burst["outlier_boxes"]:
+                box_upscaled = [max(int(value * args.scale_factor), 0) for value in box]
+                outlier_errors.append(calculateError(result, reference, box_upscaled))
+            outlier_error = max(outlier_errors) if outlier_errors else 0.
+            
+            print ("%-12s %10.2f %12.1f %12.2f %14.2f" % (stacking_mode, seconds,
+                                                          peak_memory,
+                                                          calculateError(result, reference),
+                                                          outlier_error))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+## Check that the deconvolution engines give the same result, also for
+#  images with black areas, where the convolved reconstruction is zero, and
+#  that the tiled deconvolution gives the same result as deconvolving the
+#  whole image. Exits with status 1 if a check fails.
+#
+#  usage: python benchmarks/check_deconvolution.py [--image docs/images/Sharp.jpg]
+
+import argparse
+import os
+import sys
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import Deconvolver
+
+## Deconvolve an image with the given settings
+#  @param image image as numpy float32 array
+#  @param settings dictionary of attributes of the Deconvolver
+#  @return deconvolved image as numpy float32 array
+def deconvolve(image, settings):
+    deconvolver = Deconvolver.Deconvolver()
+    for name, value in settings.items():
+        setattr(deconvolver, name, value)
+    return deconvolver.deconvolveLucy(image, [True], lambda status: None)
+
+## Compare the result of some settings with the result of reference settings
+#  @param name name of the check
+#  @param image image as numpy float32 array
+#  @param reference_settings settings of the reference result
+#  @param settings settings of the compared result
+#  @param max_difference largest allowed absolute difference
+#  @return True if the check has passed
+def check(name, image, reference_settings, settings, max_difference):
+    reference = deconvolve(image, reference_settings)
+    result = deconvolve(image, settings)
+    if not (np.all(np.isfinite(reference)) and np.all(np.isfinite(result))):
+        print ("%-40s FAILED: non-finite values" % name)
+        return False
+    difference = float(np.max(np.abs(result - reference)))
+    passed = difference <= max_difference
+    print ("%-40s %s: max difference %g" % (name, "passed" if passed else "FAILED", difference))
+    return passed
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the deconvolution engines "
+                                                 "against each other.")
+    parser.add_argument("--image", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                        "..", "docs", "images", "Sharp.jpg"))
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+    
+    image = cv2.imread(args.image)
+    if image is None:
+        print ("could not read " + args.image)
+        return 1
+    image = image.astype(np.float32)
+    
+    # a black corner, where the divisions by zero happen
+    image_with_zeros = image.copy()
+    image_with_zeros[:20, :20] = 0.
+    
+    spatial = {"iterations" : args.iterations}
+    fft = {"iterations" : args.iterations, "engine" : "fft"}
+    
+    # tiles are deconvolved with all iterations and without acceleration
+    accelerated = {"iterations" : args.iterations, "acceleration" : True,
+                   "convergence_tolerance" : 2e-3}
+    tiled = {"iterations" : args.iterations, "tile_size" : 200}
+    tiled_accelerated = dict(accelerated, tile_size=200)
+    results = [check("fft engine", image, spatial, fft, 1e-2),
+               check("fft engine with black areas", image_with_zeros, spatial, fft, 1e-2),
+               check("tiles", image, spatial, tiled, 1e-2),
+               check("tiles with acceleration", image, spatial, tiled_accelerated, 1e-2)]
+    return 0 if all(results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import cv2
+import numpy as np
+
+## Create a textured random scene
+#  @param height height of the scene in pixels
+#  @param width width of the scene in pixels
+#  @param random_generator numpy random Generator
+#  @return scene as numpy float32 array with three channels
+def createScene(height, width, random_generator):
+    scene = random_generator.random((height, width, 3)).astype(np.float32) * 255.
+    scene = cv2.GaussianBlur(scene, (0, 0), 2)
+    return np.clip((scene - scene.mean()) * 4. + 128., 0., 255.)
+
+## Write a burst of randomly shifted and rotated views of a synthetic scene
+#  to a directory. Optionally, the frames are blurred and get noise, and some
+#  frames get bright blobs that are not part of the scene, like birds or
+#  satellites.
+#  @param directory output directory for the frames
+#  @param height height of the frames in pixels
+#  @param width width of the frames in pixels
+#  @param num_images number of frames
+#  @param max_shift maximum shift of a frame in pixels
+#  @param num_outliers number of frames with an outlier blob
+#  @param seed seed of the random generator
+#  @param max_rotation maximum rotation of a frame around its center in
+#  degrees
+#  @param blur_sigma sigma of the gaussian blur of all frames in pixels
+#  @param noise_sigma standard deviation of the gaussian noise of the frames
+#  @return dictionary of {paths, shifts, transform_matrices, outlier_boxes}.
+#  shifts are the (x, y) shifts of the frames relative to the first one,
+#  transform_matrices the true 2x3 matrices W of the frames with
+#  frame(W p) = first frame(p) as used by the ImageAligner, at raw
+#  resolution, and outlier_boxes the (min_x, min_y, max_x, max_y) boxes of
+#  the blobs in the first frame.
+def createSyntheticBurst(directory, height=300, width=400, num_images=8,
+                         max_shift=3., num_outliers=0, seed=0, max_rotation=0.,
+                         blur_sigma=0., noise_sigma=0.):
+    random_generator = np.random.default_rng(seed)
+    
+    # the corners move by up to half the diagonal times the angle when
+    # rotating
+    max_rotation_shift = np.hypot(height, width) / 2. * np.radians(max_rotation)
+    border = int(np.ceil(max_shift + max_rotation_shift)) + 8
+    scene = createScene(height + 2 * border, width + 2 * border, random_generator)
+    
+    outlier_indices = random_generator.choice(np.arange(1, num_images),
+                                              min(num_outliers, num_images - 1),
+                                              replace=False)
+    
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    shifts = []
+    transform_matrices = []
+    outlier_boxes = []
+    for index in range(num_images):
+        angle = 0.
+        if index == 0:
+            shift = np.zeros(2)
+        else:
+            shift = random_generator.uniform(-max_shift, max_shift, 2)
+            if max_rotation > 0.:
+                angle = random_generator.uniform(-max_rotation, max_rotation)
+        shifts.append([float(shift[0]), float(shift[1])])
+        
+        # maps the pixels of the frame to the scene
+        warp_matrix = cv2.getRotationMatrix2D((width / 2., height / 2.), angle, 1.)
+        warp_matrix[:, 2] += border + shift
+        frame = cv2.warpAffine(scene, warp_matrix.astype(np.float32), (width, height),
+                               flags=cv2.INTER_CUBIC + cv2.WARP_INVERSE_MAP)
+        if blur_sigma > 0.:
+            frame = cv2.GaussianBlur(frame, (0, 0), blur_sigma)
+        if noise_sigma > 0.:
+            frame = frame + random_generator.normal(0., noise_sigma, frame.shape).astype(np.float32)
+        
+        # frame(W p) = scene(A W p + b) = scene(p + border) = first frame(p)
+        linear_part_inverse = np.linalg.inv(warp_matrix[:, :2])
+        transform_matrix = np.empty((2, 3))
+        transform_matrix[:, :2] = linear_part_inverse
+        transform_matrix[:, 2] = np.dot(linear_part_inverse, border - warp_matrix[:, 2])
+        transform_matrices.append(transform_matrix)
+        
+        if index in outlier_indices:
+            radius = int(min(height, width) // 12)
+            center_x = int(random_generator.integers(radius, width - radius))
+            center_y = int(random_generator.integers(radius, height - radius))
+            cv2.circle(frame, (center_x, center_y), radius, (255, 255, 255), -1)
+            
+            # box of the blob in the coordinates of the first frame
+            outlier_boxes.append([int(center_x + shift[0] - radius - max_shift),
+                                  int(center_y + shift[1] - radius - max_shift),
+                                  int(center_x + shift[0] + radius + max_shift) + 1,
+                                  int(center_y + shift[1] + radius + max_shift) + 1])
+        
+        path = os.path.join(directory, "frame_%03d.png" % index)
+        cv2.imwrite(path, np.clip(np.rint(frame), 0, 255).astype(np.uint8))
+        paths.append(path)
+        
+    return {"paths" : paths,
+            "shifts" : shifts,
+            "transform_matrices" : transform_matrices,
+            "outlier_boxes" : outlier_boxes}
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of verysharp,
+    copyright (c) 2016 Björn Sonnenschein.
+
+    verysharp is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    verysharp is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with verysharp.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import glob
+import os
+import signal
+import sys
+import ImageStacker
+import JsonLinesSink
+
+## Build the parser for the command line arguments
+#  @return argparse.ArgumentParser object
+def buildArgumentParser():
+    parser = argparse.ArgumentParser(description="Stack a series of handheld-shot "
+                                                 "photos into an image with "
+                                                 "increased resolution without "
+                                                 "starting the GUI.")
+    parser.add_argument("inputs", nargs="+",
+                        help="input images or glob patterns like 'burst/*.tif'")
+    parser.add_argument("-o", "--output", required=True,
+                        help="output path including the file extension")
+    parser.add_argument("--scale-factor", type=float, default=2.,
+                        help="upscaling factor of the output (default: 2)")
+    parser.add_argument("--tile-size", type=int, default=1024,
+                        help="size of the alignment tiles in upscaled pixels (default: 1024)")
+    parser.add_argument("--tile-margin", type=int, default=256,
+                        help="margin of the alignment tiles in upscaled pixels (default: 256)")
+    parser.add_argument("--alignment-workers", type=int, default=1,
+                        help="number of processes aligning images in parallel; "
+                             "0 uses all cpu cores (default: 1)")
+    parser.add_argument("--tile-threads", type=int, default=1,
+                        help="number of threads aligning the tiles of one image "
+                             "in parallel; 0 uses all cpu cores (default: 1)")
+    parser.add_argument("--frame-cache-size", type=float, default=0.,
+                        help="memory budget in MB for decoded frames shared by "
+                             "alignment and stacking; 0 disables the cache (default: 0)")
+    parser.add_argument("--frame-cache-compression", action="store_true",
+                        help="store cached frames compressed")
+    parser.add_argument("--frame-store", action="store_true",
+                        help="decode all frames once into a memory mapped file "
+                             "in the scratch directory shared by all stages "
+                             "and alignment workers")
+    parser.add_argument("--frame-store-gray", action="store_true",
+                        help="also store a greyscale plane of the frames and "
+                             "align on it")
+    parser.add_argument("--frame-store-workers", type=int, default=0,
+                        help="number of threads decoding the frames into the "
+                             "frame store; 0 uses all cpu cores (default: 0)")
+    parser.add_argument("--initial-estimate", choices=["phase_correlation", "feature", "none"],
+                        default="phase_correlation",
+                        help="initial estimate for ECC; 'feature' needs "
+                             "OpenCV < 4 (default: phase_correlation)")
+    parser.add_argument("--estimate-rotation", action="store_true",
+                        help="also estimate the rotation of each tile by "
+                             "log-polar phase correlation")
+    parser.add_argument("--streaming", action="store_true",
+                        help="align and stack in a single pass, so that every "
+                             "image is decoded and upscaled only once")
+    parser.add_argument("--keep-best", type=int, default=0,
+                        help="only stack the given number of sharpest frames; "
+                             "0 keeps all (default: 0)")
+    parser.add_argument("--keep-fraction", type=float, default=1.,
+                        help="only stack the given fraction of sharpest frames "
+                             "(default: 1.0)")
+    parser.add_argument("--quality-metric", choices=["laplacian", "gradient"],
+                        default="laplacian",
+                        help="sharpness measure for the frame selection "
+                             "(default: laplacian)")
+    parser.add_argument("--scoring-workers", type=int, default=1,
+                        help="number of threads scoring frames; 0 uses all "
+                             "cores (default: 1)")
+    parser.add_argument("--alignment-method", choices=["ecc", "pyramid"], default="ecc",
+                        help="'ecc' aligns the full upscaled tiles, 'pyramid' "
+                             "aligns coarse to fine and only refines on the "
+                             "upscaled tiles (default: ecc)")
+    parser.add_argument("--pyramid-levels", type=int, default=3,
+                        help="number of pyramid levels below the upscaled "
+                             "resolution (default: 3)")
+    parser.add_argument("--refinement-iterations", type=int, default=10,
+                        help="ECC iterations on the upscaled tiles for pyramid "
+                             "alignment (default: 10)")
+    parser.add_argument("--refinement-eps", type=float, default=1e-4,
+                        help="correlation increment at which the refinement "
+                             "stops; smaller values give higher sub-pixel "
+                             "accuracy (default: 1e-4)")
+    parser.add_argument("--temporal-prediction", choices=["none", "previous", "linear"],
+                        default="none",
+                        help="start the alignment of each tile from the "
+                             "transform of the previous image or a linear "
+                             "extrapolation of the last two, and only "
+                             "estimate it from scratch if the correlation "
+                             "is poor; not used with multiple alignment "
+                             "workers (default: none)")
+    parser.add_argument("--warm-start-tolerance", type=float, default=0.02,
+                        help="fall back to the initial estimate if the "
+                             "correlation coefficient of a tile drops by "
+                             "more than this compared to the previous image "
+                             "(default: 0.02)")
+    parser.add_argument("--min-tile-texture", type=float, default=0.,
+                        help="tiles of the reference image with less texture, "
+                             "like blank sky, are not aligned; their transforms "
+                             "are interpolated from the textured tiles. About "
+                             "1 skips tiles that contain mostly noise "
+                             "(default: 0, align all tiles)")
+    parser.add_argument("--alignment-cache", default=None,
+                        help="directory of a persistent cache of alignment "
+                             "results, so that re-running a burst with other "
+                             "stacking or deconvolution settings skips the "
+                             "alignment (default: no cache)")
+    parser.add_argument("--alignment-cache-size", type=float, default=100.,
+                        help="size limit of the alignment cache in MB; the "
+                             "least recently used entries are deleted "
+                             "(default: 100)")
+    parser.add_argument("--clear-alignment-cache", action="store_true",
+                        help="delete all entries of the alignment cache "
+                             "before the run")
+    parser.add_argument("--checkpoint", default=None,
+                        help="directory for checkpoints of the alignment and "
+                             "the partially stacked image, which are saved "
+                             "periodically and when the run is aborted or "
+                             "terminated (default: no checkpoints)")
+    parser.add_argument("--checkpoint-interval", type=int, default=10,
+                        help="number of images after which a checkpoint is "
+                             "saved (default: 10)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the checkpoint of a previous run "
+                             "with the same images and settings")
+    parser.add_argument("--out-of-core", action="store_true",
+                        help="keep the stacked image in a memory mapped file "
+                             "and upscale tile by tile to bound memory")
+    parser.add_argument("--scratch-directory", default=None,
+                        help="directory for the memory mapped files "
+                             "(default: system temporary directory)")
+    parser.add_argument("--warp-engine", choices=["tiles", "direct", "remap"], default="tiles",
+                        help="'tiles' upscales each image and warps the "
+                             "upscaled tiles, 'direct' combines upscaling and "
+                             "alignment into a single interpolation, 'remap' "
+                             "also blends the tile transforms into a smooth "
+                             "dense map without seams (default: tiles)")
+    parser.add_argument("--correct-seeing", action="store_true",
+                        help="measure the distortion of each image by seeing "
+                             "or heat shimmer with optical flow and correct "
+                             "it; not available with --streaming")
+    parser.add_argument("--flow-workers", type=int, default=1,
+                        help="number of threads calculating optical flows; "
+                             "0 uses all cores (default: 1)")
+    parser.add_argument("--stacking-mode", choices=["mean", "sigma_clip", "median"],
+                        default="mean",
+                        help="'sigma_clip' and 'median' reject outliers like "
+                             "satellites or birds; 'median' needs disk space "
+                             "for all upscaled images in the scratch "
+                             "directory. 'sigma_clip' keeps three upscaled "
+                             "images in memory unless --out-of-core is given "
+                             "(default: mean)")
+    parser.add_argument("--sigma-clip-kappa", type=float, default=2.5,
+                        help="values deviating more than kappa standard "
+                             "deviations from the mean are rejected "
+                             "(default: 2.5)")
+    parser.add_argument("--diagnostics-directory", default=None,
+                        help="write diagnostic images like optical flows, "
+                             "alignment residuals and tile maps into this "
+                             "directory (default: no diagnostics)")
+    parser.add_argument("--report", default=None,
+                        help="write a JSON report with the quality scores and "
+                             "alignment correlation coefficients of the frames "
+                             "to this path")
+    parser.add_argument("--metrics", default=None,
+                        help="write timing events of all stages, like "
+                             "decoding, alignment of each tile, warping and "
+                             "deconvolution iterations, as JSON lines to this "
+                             "file")
+    parser.add_argument("--no-deconvolve", action="store_true",
+                        help="do not apply Richardson-Lucy deconvolution")
+    parser.add_argument("--deconvolution-sigma", type=float, default=1.1,
+                        help="sigma of the gaussian psf (default: 1.1)")
+    parser.add_argument("--deconvolution-iterations", type=int, default=40,
+                        help="number of Richardson-Lucy iterations (default: 40)")
+    parser.add_argument("--deconvolution-kernel-size", type=int, default=5,
+                        help="size of the psf kernel in pixels (default: 5)")
+    parser.add_argument("--deconvolution-engine", choices=["spatial", "fft"], default="spatial",
+                        help="convolve with filter2D or in the frequency domain; "
+                             "fft is faster for large kernels (default: spatial)")
+    parser.add_argument("--deconvolution-acceleration", action="store_true",
+                        help="accelerate Richardson-Lucy by Biggs-Andrews extrapolation; "
+                             "about 12 accelerated iterations match 40 plain ones")
+    parser.add_argument("--deconvolution-tolerance", type=float, default=0.,
+                        help="stop deconvolving once the relative change per "
+                             "iteration is below this value; 0 always runs all "
+                             "iterations (default: 0)")
+    parser.add_argument("--deconvolution-tile-size", type=int, default=0,
+                        help="deconvolve in tiles of this size to bound memory; "
+                             "0 deconvolves the whole image at once (default: 0)")
+    parser.add_argument("--deconvolution-workers", type=int, default=1,
+                        help="number of processes deconvolving tiles in parallel; "
+                             "0 uses all cpu cores (default: 1)")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="do not print status updates")
+    return parser
+
+## Expand the glob patterns given on the command line. Patterns matching no
+#  file are kept as they are, so that missing files are reported.
+#  @param inputs list of paths and glob patterns
+#  @return list of image paths
+def expandInputPaths(inputs):
+    image_paths = []
+    for pattern in inputs:
+        matches = sorted(glob.glob(pattern))
+        if matches:
+            image_paths.extend(matches)
+        else:
+            image_paths.append(pattern)
+    return image_paths
+    
+def main(argv=None):
+    parser = buildArgumentParser()
+    args = parser.parse_args(argv)
+    
+    image_paths = expandInputPaths(args.inputs)
+    if len(image_paths) < 2:
+        parser.error("at least two input images are needed")
+    missing_paths = [path for path in image_paths if not os.path.isfile(path)]
+    if missing_paths:
+        parser.error("input images not found: " + ", ".join(missing_paths))
+    if args.deconvolution_tile_size > 0 and (args.deconvolution_acceleration
+                                             or args.deconvolution_tolerance > 0.):
+        parser.error("--deconvolution-acceleration and --deconvolution-tolerance "
+                     "are not available with --deconvolution-tile-size")
+    if args.correct_seeing and args.streaming:
+        parser.error("--correct-seeing is not available with --streaming")
+    
+    status_callback = None if args.quiet else print
+    image_stacker = ImageStacker.ImageStacker(image_paths,
+                                              args.output,
+                                              status_callback)
+    image_stacker.scale_factor = args.scale_factor
+    image_stacker.tile_size = args.tile_size
+    image_stacker.tile_margin = args.tile_margin
+    image_stacker.image_aligner.num_workers = args.alignment_workers
+    image_stacker.image_aligner.num_tile_threads = args.tile_threads
+    image_stacker.frame_cache_size = int(args.frame_cache_size * 1024 * 1024)
+    image_stacker.frame_cache_compression = args.frame_cache_compression
+    image_stacker.use_frame_store = args.frame_store
+    image_stacker.frame_store_gray = args.frame_store_gray
+    image_stacker.frame_store_workers = args.frame_store_workers
+    image_stacker.frame_selector.keep_count = args.keep_best
+    image_stacker.frame_selector.keep_fraction = args.keep_fraction
+    image_stacker.frame_selector.metric = args.quality_metric
+    image_stacker.frame_selector.num_workers = args.scoring_workers
+    image_stacker.image_aligner.alignment_method = args.alignment_method
+    image_stacker.image_aligner.pyramid_levels = args.pyramid_levels
+    image_stacker.image_aligner.refinement_iterations = args.refinement_iterations
+    image_stacker.image_aligner.refinement_eps = args.refinement_eps
+    image_stacker.image_aligner.initial_estimate = args.initial_estimate
+    image_stacker.image_aligner.estimate_rotation = args.estimate_rotation
+    image_stacker.image_aligner.temporal_prediction = args.temporal_prediction
+    image_stacker.image_aligner.warm_start_tolerance = args.warm_start_tolerance
+    image_stacker.image_aligner.min_tile_texture = args.min_tile_texture
+    image_stacker.alignment_cache_directory = args.alignment_cache
+    image_stacker.alignment_cache_size = int(args.alignment_cache_size * 1024 * 1024)
+    image_stacker.clear_alignment_cache = args.clear_alignment_cache
+    image_stacker.checkpoint_directory = args.checkpoint
+    image_stacker.checkpoint_interval = args.checkpoint_interval
+    image_stacker.resume = args.resume
+    image_stacker.streaming = args.streaming
+    image_stacker.out_of_core = args.out_of_core
+    image_stacker.scratch_directory = args.scratch_directory
+    image_stacker.warp_engine = args.warp_engine
+    image_stacker.correct_seeing = args.correct_seeing
+    image_stacker.flow_calculator.num_workers = args.flow_workers
+    image_stacker.stacking_mode = args.stacking_mode
+    image_stacker.robust_stacker.kappa = args.sigma_clip_kappa
+    image_stacker.diagnostics_directory = args.diagnostics_directory
+    image_stacker.report_path = args.report
+    image_stacker.bool_deconvolve = not args.no_deconvolve
+    image_stacker.deconvolver.sigma = args.deconvolution_sigma
+    image_stacker.deconvolver.iterations = args.deconvolution_iterations
+    image_stacker.deconvolver.kernel_size = args.deconvolution_kernel_size
+    image_stacker.deconvolver.engine = args.deconvolution_engine
+    image_stacker.deconvolver.acceleration = args.deconvolution_acceleration
+    image_stacker.deconvolver.convergence_tolerance = args.deconvolution_tolerance
+    image_stacker.deconvolver.tile_size = args.deconvolution_tile_size
+    image_stacker.deconvolver.num_workers = args.deconvolution_workers
+    
+    if args.checkpoint is not None:
+        # abort cleanly when terminated, e.g. on preemption, so that the
+        # current progress is saved in the checkpoint
+        signal.signal(signal.SIGTERM, lambda signum, frame: image_stacker.abort())
+    
+    metrics_sink = None
+    if args.metrics is not None:
+        metrics_sink = JsonLinesSink.JsonLinesSink(args.metrics)
+        image_stacker.instrumentation.addSink(metrics_sink)
+    
+    try:
+        result = image_stacker.stackImages()
+    except KeyboardInterrupt:
+        image_stacker.abort()
+        result = "aborted"
+    finally:
+        if metrics_sink is not None:
+            metrics_sink.close()
+        
+    if isinstance(result, str) and result == "aborted":
+        print ("aborted")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())